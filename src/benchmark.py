@@ -0,0 +1,218 @@
+"""
+Offline benchmark suite. Runs our hot paths (retrieval, reranking, SemScore, the Pipeline and
+the Verifier) against a synthetic corpus and a local FakeOllama server, so it needs no GPU and
+no real Ollama. Embedding and reranking models are the real ones, on CPU.
+
+Usage
+-----
+python -m src.benchmark --corpus-size 2000 --queries 100 --output bench.json
+"""
+import io
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import contextlib
+import pandas as pd
+
+from pathlib import Path
+from src.fake_ollama import FakeOllama
+from src.metrics import percentiles
+
+TOPICS = ['firewall','phishing','backup','endpoint','SOC','penetration test','ransomware','MFA',
+          'cloud hosting','incident response','GDPR','vulnerability scan','VPN','email security']
+
+def synthetic_corpus(size:int,seed:int=0):
+    """
+    Make a knowledge base of question/response pairs shaped like the real one
+
+    Parameters
+    ----------
+    size : `int`
+        number of rows
+    seed : `int`
+        random seed
+
+    Returns
+    -------
+    `pd.DataFrame`
+        id, question and response columns
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(size):
+        a,b = rng.sample(TOPICS,2)
+        rows.append({'id':i,
+                     'question':f'How does METCLOUD handle {a} for customers using {b}? (case {i})',
+                     'response':f'We provide managed {a} alongside {b}, monitored 24/7 by our team. Reference {i}.'})
+    return pd.DataFrame(rows)
+
+def summarise(timings:list):
+    """
+    Summary statistics of a list of timings in seconds
+
+    Returns
+    -------
+    `dict`
+        n, total, mean and p50/p95/p99
+    """
+    return {'n':len(timings),'total':float(sum(timings)),
+            'mean':float(sum(timings)/len(timings)) if timings else None,
+            **percentiles(timings)}
+
+def time_each(fn,items:list):
+    """
+    Call fn on every item, timing each call
+
+    Returns
+    -------
+    `dict`
+        see `summarise`
+    """
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        timings.append(time.perf_counter()-start)
+    return summarise(timings)
+
+def time_once(fn,n:int):
+    """
+    Time a single batched call that handles n items
+
+    Returns
+    -------
+    `dict`
+        total seconds plus the per-item mean
+    """
+    start = time.perf_counter()
+    fn()
+    total = time.perf_counter()-start
+    return {'n':n,'total':total,'mean':total/n if n else None}
+
+def run(args):
+    """
+    Run every benchmark
+
+    Parameters
+    ----------
+    args : `argparse.Namespace`
+        parsed command line, see `main`
+
+    Returns
+    -------
+    `dict`
+        machine readable results
+    """
+    server = FakeOllama(latency=args.latency,tokens_per_second=args.tokens_per_second,
+                        response_tokens=args.response_tokens).start()
+    #imported here so --help works without the heavy dependencies
+    from src.llm import LLMClient
+    from src.pipeline import Pipeline
+    from src.verifier import Verifier
+    from src.semscore import sem_score, sem_score_batch
+
+    workdir = Path(args.workdir)
+    pipe_dir = workdir/'pipeline'
+    for stale in ['chromadb','flat_index']:
+        shutil.rmtree(pipe_dir/stale,ignore_errors=True)
+
+    corpus = synthetic_corpus(args.corpus_size,seed=args.seed)
+    rng = random.Random(args.seed)
+    hits = rng.sample(corpus['question'].tolist(),min(args.queries//2,len(corpus)))
+    misses = [f'What is the best way to cook {rng.choice(["rice","pasta","fish"])} number {i}?'
+              for i in range(args.queries-len(hits))]
+    queries = hits + misses
+
+    llm = LLMClient(hosts=[server.url])
+    results = {}
+    quiet = contextlib.redirect_stdout(io.StringIO())
+
+    #startup + ingest
+    start = time.perf_counter()
+    pipe = Pipeline(llm_model='fake-llm',emb_model=args.embedding_model,corpus=corpus,
+                    cache=str(pipe_dir),embedding_cache=None,llm=llm)
+    results['pipeline_startup'] = {'total':time.perf_counter()-start,**pipe.chroma_db.startup_report()}
+    db = pipe.chroma_db
+
+    #retrieval, chroma then flat backend. first call warms the models up
+    db.retrieve(queries[0],k=1)
+    results['retrieve_chroma'] = time_each(lambda q: db.retrieve(q,k=1),queries)
+    db.backend = 'flat'
+    results['flat_index_build'] = time_once(lambda: db.flat_index,len(corpus))
+    results['retrieve_flat'] = time_each(lambda q: db.retrieve(q,k=1),queries)
+    results['retrieve_many_flat'] = time_once(lambda: db.retrieve_many(queries,k=1),len(queries))
+    db.backend = 'chroma'
+    results['retrieve_many_chroma'] = time_once(lambda: db.retrieve_many(queries,k=1),len(queries))
+
+    #reranking
+    db.rerank(queries[0],db.search(queries[0],10))
+    candidates = {q:db.search(q,10) for q in queries}
+    results['rerank'] = time_each(lambda q: db.rerank(q,candidates[q]),queries)
+    results['retrieve_advanced'] = time_each(lambda q: db.retrieve(q,k=1,advanced=True),queries)
+
+    #semscore
+    verifier = Verifier(model='fake-judge',embedding_model=args.embedding_model,
+                        cache_dir=str(pipe_dir/'huggingface_cache'),embedding_cache=None,llm=llm,verdict_cache=None)
+    pairs = list(zip(corpus['response'].head(args.queries),corpus['question'].head(args.queries)))
+    results['sem_score'] = time_each(lambda p: sem_score(p[0],p[1],func=verifier.emb_func),pairs)
+    results['sem_score_batch'] = time_once(lambda: sem_score_batch([a for a,b in pairs],[b for a,b in pairs],
+                                                                   func=verifier.emb_func),len(pairs))
+
+    #end to end pipeline against the fake server
+    with quiet:
+        results['pipeline_ask_question'] = time_each(lambda q: pipe.ask_question(q),queries)
+        results['pipeline_ask_question_speculative'] = time_each(lambda q: pipe.ask_question(q,speculative=True),queries)
+    results['pipeline_stages'] = pipe.metrics.summary().to_dict(orient='records')
+    pipe.close()
+
+    #verifier, serial then concurrent
+    answers = corpus.head(args.queries).copy()
+    answers['llm_response'] = answers['response'].str.replace('managed','monitored')
+    answers['time'] = 1.0
+    answers['tps'] = 10.0
+    with quiet:
+        results['judge_all_questions'] = time_once(
+            lambda: verifier.judge_all_questions(answers,'bench',workdir/'verifier'),len(answers))
+        results[f'judge_all_questions_workers_{args.workers}'] = time_once(
+            lambda: verifier.judge_all_questions(answers,'bench',workdir/'verifier',workers=args.workers),len(answers))
+        compact = Verifier(model='fake-judge',embedding_model=args.embedding_model,
+                           cache_dir=str(pipe_dir/'huggingface_cache'),embedding_cache=None,llm=llm,verdict_cache=None,
+                           structured=True,verdict_only=True)
+        results[f'judge_all_questions_verdict_only_workers_{args.workers}'] = time_once(
+            lambda: compact.judge_all_questions(answers,'bench',workdir/'verifier',workers=args.workers),len(answers))
+
+    server.stop()
+    return {'config':vars(args),
+            'environment':{'python':platform.python_version(),'platform':platform.platform(),
+                           'cpu_count':os.cpu_count()},
+            'fake_ollama_requests':server.requests,
+            'results':results}
+
+def main(argv:list=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks against a fake Ollama server')
+    parser.add_argument('--corpus-size',type=int,default=1000,help='rows in the synthetic knowledge base')
+    parser.add_argument('--queries',type=int,default=50,help='questions per benchmark')
+    parser.add_argument('--embedding-model',default='all-MiniLM-L6-v2',help='sentence-transformers model')
+    parser.add_argument('--latency',type=float,default=0.02,help='fake Ollama seconds before first token')
+    parser.add_argument('--tokens-per-second',type=float,default=200.0,help='fake Ollama decode rate')
+    parser.add_argument('--response-tokens',type=int,default=40,help='tokens per fake response')
+    parser.add_argument('--workers',type=int,default=8,help='concurrency for the concurrent verifier run')
+    parser.add_argument('--workdir',default='benchmark_cache',help='where models, the vector db and outputs go')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--output',default=None,help='write JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report,indent=2,default=str)
+    if args.output is None:
+        print(text)
+    else:
+        Path(args.output).write_text(text)
+        print(f'results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import time
+import sqlite3
+import hashlib
+import threading
+
+from pathlib import Path
+
+def content_hash(*parts:str):
+  """
+  Stable hash of one or more strings, used as a cache key
+
+  Parameters
+  ----------
+  parts : `str`
+      strings to hash. Order matters
+
+  Returns
+  -------
+  `str`
+      hex sha256 digest
+  """
+  h = hashlib.sha256()
+  for p in parts:
+    h.update(str(p).encode('utf-8'))
+    h.update(b'\0')
+  return h.hexdigest()
+
+def cache_path(path:str,cache_dir:str):
+  """
+  Resolve where an on-disk cache lives. A relative path is put under cache_dir
+
+  Parameters
+  ----------
+  path : `str`
+      file name or path of the cache, None for no cache
+  cache_dir : `str`
+      folder relative paths are resolved against
+
+  Returns
+  -------
+  `str`
+      the path, None if path is None
+  """
+  if path is None:
+    return None
+  return str(Path(cache_dir)/path)
+
+class SQLiteLRUCache:
+  """
+  Small on-disk key/value store with a size cap and least-recently-used eviction.
+  Backed by a single sqlite file so it survives restarts and can be shared by
+  several processes. Safe to use from multiple threads.
+
+  Parameters
+  ----------
+  path : `str`
+      location of the sqlite file
+  max_entries : `int`
+      maximum number of entries kept. The least recently used are evicted beyond this
+  """
+  def __init__(self,path:str,max_entries:int=1_000_000):
+    self.path = Path(path)
+    self.path.parent.mkdir(exist_ok=True,parents=True)
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(str(self.path),timeout=30,check_same_thread=False)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, last_used REAL)')
+    self._conn.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)')
+    self._conn.commit()
+
+    #number of entries: the last count plus the entries written since, see put_many
+    self._count = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+  def __len__(self):
+    with self._lock:
+      return self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+  def get_many(self,keys:list):
+    """
+    Look up many keys at once
+
+    Parameters
+    ----------
+    keys : `list`
+        keys to look up
+
+    Returns
+    -------
+    `dict`
+        key -> value for the keys that were found
+    """
+    found = {}
+    if len(keys) == 0:
+      return found
+    unique = list(dict.fromkeys(keys))
+    with self._lock:
+      #sqlite limits the number of bound parameters, so query in chunks
+      for i in range(0,len(unique),500):
+        chunk = unique[i:i+500]
+        rows = self._conn.execute(
+          f'SELECT key, value FROM cache WHERE key IN ({",".join("?"*len(chunk))})',chunk
+        ).fetchall()
+        found.update(rows)
+      if found:
+        now = time.time()
+        self._conn.executemany('UPDATE cache SET last_used = ? WHERE key = ?',
+                               [(now,k) for k in found])
+        self._conn.commit()
+      self.hits += sum(1 for k in keys if k in found)
+      self.misses += sum(1 for k in keys if k not in found)
+    return found
+
+  def get(self,key:str):
+    """
+    Look up a single key. Returns None on a miss
+    """
+    return self.get_many([key]).get(key)
+
+  def put_many(self,items:dict):
+    """
+    Store many values, then evict the least recently used entries over the cap. The table is
+    only counted once this process may have taken it over the cap, and eviction goes 1% below
+    the cap so that the next count is many inserts away
+
+    Parameters
+    ----------
+    items : `dict`
+        key -> bytes value
+    """
+    if len(items) == 0:
+      return
+    now = time.time()
+    with self._lock:
+      self._conn.executemany('INSERT OR REPLACE INTO cache (key, value, last_used) VALUES (?, ?, ?)',
+                             [(k,v,now) for k,v in items.items()])
+      #replaced keys are counted as new, so this never underestimates this process's writes
+      self._count += len(items)
+      if self._count > self.max_entries:
+        self._count = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if self._count > self.max_entries:
+          excess = self._count - (self.max_entries - self.max_entries//100)
+          self._conn.execute('DELETE FROM cache WHERE key IN '
+                             '(SELECT key FROM cache ORDER BY last_used ASC LIMIT ?)',(excess,))
+          self._count -= excess
+      self._conn.commit()
+
+  def put(self,key:str,value:bytes):
+    """
+    Store a single value
+    """
+    self.put_many({key:value})
+
+  def clear(self):
+    """
+    Remove every entry and reset the counters
+    """
+    with self._lock:
+      self._conn.execute('DELETE FROM cache')
+      self._conn.commit()
+      self._count = 0
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    """
+    Hit/miss counters since this object was created
+
+    Returns
+    -------
+    `dict`
+        hits, misses, hit_rate and entries
+    """
+    total = self.hits + self.misses
+    return {'hits':self.hits,'misses':self.misses,
+            'hit_rate':self.hits/total if total else 0.0,
+            'entries':len(self)}
@@ -0,0 +1,195 @@
+import time
+import threading
+import numpy as np
+
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.embeddings.base import Embeddings
+from src.cache import SQLiteLRUCache, content_hash
+
+#file name of the on-disk embedding cache, kept under the caller's cache_dir unless an absolute
+#path is given. /data is mounted by docker-compose so the defaults persist between runs
+DEFAULT_EMBEDDING_CACHE = 'embedding_cache.sqlite'
+
+#process-wide embedding models and caches, so repeated calls do not reload anything
+_EMBEDDING_FUNCTIONS = {}
+_CACHES = {}
+_LOCK = threading.Lock()
+
+class LazyEmbeddings(Embeddings):
+  """
+  HuggingFace embedding function that only loads its weights on the first embed call,
+  so constructing objects that hold one is cheap.
+
+  Parameters
+  ----------
+  model_name : `str`
+      full huggingface model name
+  cache_folder : `str`
+      place to store weights
+  """
+  def __init__(self,model_name:str,cache_folder:str):
+    self.model_name = model_name
+    self.cache_folder = cache_folder
+    self.load_time = None #seconds spent loading, None until loaded
+    self._embeddings = None
+    self._lock = threading.Lock()
+
+  @property
+  def embeddings(self):
+    """
+    The underlying HuggingFaceEmbeddings, loaded on first access
+    """
+    if self._embeddings is None:
+      with self._lock:
+        if self._embeddings is None:
+          start = time.time()
+          self._embeddings = HuggingFaceEmbeddings(
+              model_name = self.model_name,
+              cache_folder = self.cache_folder
+          )
+          self.load_time = time.time() - start
+    return self._embeddings
+
+  def embed_documents(self,texts:list):
+    return self.embeddings.embed_documents(texts)
+
+  def embed_query(self,text:str):
+    return self.embeddings.embed_query(text)
+
+class CachedEmbeddings(Embeddings):
+  """
+  Content-addressed cache around an embedding function. Vectors are stored on disk keyed by
+  (model name, text hash), so a string is only ever embedded once per model.
+
+  Parameters
+  ----------
+  embeddings : `Embeddings`
+      the embedding function to wrap
+  model_name : `str`
+      name of the embedding model, part of the cache key
+  cache : `SQLiteLRUCache`
+      where vectors are stored
+  """
+  def __init__(self,embeddings:Embeddings,model_name:str,cache:SQLiteLRUCache):
+    self.embeddings = embeddings
+    self.model_name = model_name
+    self.cache = cache
+
+  @property
+  def load_time(self):
+    """
+    Load time of the wrapped embedding function, if it reports one
+    """
+    return getattr(self.embeddings,'load_time',None)
+
+  def key(self,text:str):
+    """
+    Cache key of a text for this model
+    """
+    return content_hash(self.model_name,text)
+
+  def embed_documents(self,texts:list):
+    """
+    Embed a list of texts, only computing the ones not already cached
+
+    Parameters
+    ----------
+    texts : `list`
+        texts to embed
+
+    Returns
+    -------
+    `list`
+        one embedding (list of floats) per text
+    """
+    keys = [self.key(t) for t in texts]
+    found = self.cache.get_many(keys)
+
+    #embed each missing text once, even if it appears several times
+    missing = {}
+    for k,t in zip(keys,texts):
+      if k not in found:
+        missing.setdefault(k,t)
+    if missing:
+      vectors = self.embeddings.embed_documents(list(missing.values()))
+      new = {k:np.asarray(v,dtype=np.float32).tobytes() for k,v in zip(missing.keys(),vectors)}
+      self.cache.put_many(new)
+      found.update(new)
+
+    return [np.frombuffer(found[k],dtype=np.float32).tolist() for k in keys]
+
+  def embed_query(self,text:str):
+    """
+    Embed a single text
+
+    Parameters
+    ----------
+    text : `str`
+        text to embed
+
+    Returns
+    -------
+    `list`
+        the embedding
+    """
+    k = self.key(text)
+    value = self.cache.get(k)
+    if value is None:
+      vector = self.embeddings.embed_query(text)
+      value = np.asarray(vector,dtype=np.float32).tobytes()
+      self.cache.put(k,value)
+    return np.frombuffer(value,dtype=np.float32).tolist()
+
+def get_embedding_cache(path:str,max_entries:int=1_000_000):
+  """
+  Get the process-wide embedding cache stored at path
+
+  Parameters
+  ----------
+  path : `str`
+      location of the sqlite file
+  max_entries : `int`
+      maximum number of vectors kept on disk
+
+  Returns
+  -------
+  `SQLiteLRUCache`
+  """
+  with _LOCK:
+    if str(path) not in _CACHES:
+      _CACHES[str(path)] = SQLiteLRUCache(path,max_entries=max_entries)
+    return _CACHES[str(path)]
+
+def get_embedding_function(embedding_model:str="all-mpnet-base-v2",cache_dir:str='/data/cache',
+                           embedding_cache:str=None):
+  """
+  Get a shared HuggingFace embedding function. Each (model, cache_dir) pair is only
+  loaded once per process, and only when something is first embedded.
+
+  Parameters
+  ----------
+  embedding_model : `str`
+      sentence-transformers model name
+  cache_dir : `str`
+      place to store weights
+  embedding_cache : `str`
+      optional path of an on-disk embedding cache to put in front of the model
+
+  Returns
+  -------
+  `Embeddings`
+      The embedding function
+  """
+  key = (embedding_model,str(cache_dir))
+  with _LOCK:
+    if key not in _EMBEDDING_FUNCTIONS:
+      _EMBEDDING_FUNCTIONS[key] = LazyEmbeddings(
+          model_name = f'sentence-transformers/{embedding_model}',
+          cache_folder = str(cache_dir)
+      )
+    func = _EMBEDDING_FUNCTIONS[key]
+
+  if embedding_cache is None:
+    return func
+  return CachedEmbeddings(func,f'sentence-transformers/{embedding_model}',
+                          get_embedding_cache(embedding_cache))
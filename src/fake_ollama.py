@@ -0,0 +1,181 @@
+import json
+import time
+import zlib
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeOllama:
+  """
+  Local stand-in for an Ollama server, for benchmarking without a GPU. Speaks enough of the
+  `/api/generate` protocol (blocking and streamed) for the `ollama` client, and answers the
+  pipeline's prompts in the expected shape:
+
+  - classifier prompts ("Does this question ...") get "True" or "False"
+  - judge prompts get a JSON verdict
+  - everything else gets filler text
+
+  Timing is simulated with a fixed prefill latency plus a decode rate, and the usual Ollama
+  duration and token count fields are filled in.
+
+  Parameters
+  ----------
+  host : `str`
+      interface to bind
+  port : `int`
+      port to bind, 0 for any free port
+  latency : `float`
+      seconds before the first token (simulated load + prefill)
+  tokens_per_second : `float`
+      simulated decode rate
+  response_tokens : `int`
+      number of tokens in filler responses
+
+  Usage
+  -----
+  with FakeOllama(latency=0.05,tokens_per_second=100) as server:
+      client = ollama.Client(host=server.url)
+  """
+  def __init__(self,host:str='127.0.0.1',port:int=0,latency:float=0.05,tokens_per_second:float=50.0,
+               response_tokens:int=40):
+    self.latency = latency
+    self.tokens_per_second = tokens_per_second
+    self.response_tokens = response_tokens
+    self.requests = 0
+    self._lock = threading.Lock()
+    self._server = ThreadingHTTPServer((host,port),self._handler())
+    self._server.daemon_threads = True
+    self._thread = None
+
+  @property
+  def url(self):
+    """
+    Base url to point an Ollama client at
+    """
+    host,port = self._server.server_address[:2]
+    return f'http://{host}:{port}'
+
+  def start(self):
+    """
+    Serve requests in a background thread
+    """
+    self._thread = threading.Thread(target=self._server.serve_forever,daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    """
+    Shut the server down
+    """
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self,*exc):
+    self.stop()
+
+  def reply(self,body:dict):
+    """
+    Decide what to answer for a generate request
+
+    Parameters
+    ----------
+    body : `dict`
+        the request body
+
+    Returns
+    -------
+    `list`
+        response tokens
+    """
+    prompt = body.get('prompt') or ''
+    system = body.get('system') or ''
+    #deterministic pseudo-random choice per prompt
+    coin = zlib.crc32(prompt.encode('utf-8')) % 2 == 0
+
+    if prompt.startswith('Does this question'):
+      return ['True' if coin else 'False']
+    if 'validation capability' in system:
+      #the judge prompt is always the same, the answer pair is in the system prompt
+      coin = zlib.crc32(system.encode('utf-8')) % 2 == 0
+      verdict = {'consistent':'True' if coin else 'False'}
+      if 'justification' in system:
+        verdict['justification'] = 'The samples share the same key facts.'
+      return [json.dumps(verdict)]
+    return [f'token{i} ' for i in range(self.response_tokens)]
+
+  def _handler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self,*args):
+        pass
+
+      def _send_json(self,payload:dict,status:int=200):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def do_GET(self):
+        if self.path == '/api/version':
+          self._send_json({'version':'0.0.0-fake'})
+        elif self.path == '/api/tags':
+          self._send_json({'models':[]})
+        else:
+          data = b'Ollama is running'
+          self.send_response(200)
+          self.send_header('Content-Length',str(len(data)))
+          self.end_headers()
+          self.wfile.write(data)
+
+      def do_POST(self):
+        length = int(self.headers.get('Content-Length',0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if self.path != '/api/generate':
+          self._send_json({'error':f'{self.path} not supported by FakeOllama'},status=404)
+          return
+        with server._lock:
+          server.requests += 1
+
+        tokens = server.reply(body)
+        prompt_tokens = len(((body.get('system') or '') + (body.get('prompt') or '')).split())
+        decode = len(tokens)/server.tokens_per_second
+        final = {'model':body.get('model'),'created_at':time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'done':True,'done_reason':'stop',
+                 'total_duration':int((server.latency+decode)*1e9),
+                 'load_duration':0,
+                 'prompt_eval_count':prompt_tokens,
+                 'prompt_eval_duration':int(server.latency*1e9),
+                 'eval_count':len(tokens),
+                 'eval_duration':int(decode*1e9)}
+
+        time.sleep(server.latency)
+        if not body.get('stream',True):
+          time.sleep(decode)
+          self._send_json({**final,'response':''.join(tokens)})
+          return
+
+        #stream one json line per token, chunked encoding like the real server
+        self.send_response(200)
+        self.send_header('Content-Type','application/x-ndjson')
+        self.send_header('Transfer-Encoding','chunked')
+        self.end_headers()
+        for token in tokens:
+          time.sleep(1/server.tokens_per_second)
+          self._chunk({'model':body.get('model'),'response':token,'done':False})
+        self._chunk({**final,'response':''})
+        self.wfile.write(b'0\r\n\r\n')
+
+      def _chunk(self,payload:dict):
+        data = (json.dumps(payload)+'\n').encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii')+data+b'\r\n')
+        self.wfile.flush()
+
+    return Handler
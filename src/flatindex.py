@@ -0,0 +1,149 @@
+import json
+import math
+import shutil
+import numpy as np
+
+from pathlib import Path
+from langchain.schema.document import Document
+
+class FlatIndex:
+  """
+  Exact in-process vector index over a Chroma collection. Normalised corpus embeddings live in
+  a contiguous memory-mapped array on disk, so a warm start only maps the file, and a top-k
+  search is one matrix-vector product plus `argpartition`.
+
+  Scores are the same relevance scores langchain's Chroma wrapper gives for the default "l2"
+  space, i.e. 1 - squared_l2_distance / sqrt(2), so thresholds mean the same thing.
+
+  Parameters
+  ----------
+  index_dir : `str`
+      folder holding the index files
+  dtype : `str`
+      'float32', or 'float16' to halve memory and disk at some speed cost
+  """
+  def __init__(self,index_dir:str,dtype:str='float32'):
+    self.index_dir = Path(index_dir)
+    self.dtype = np.dtype(dtype)
+    self.vectors = None   #(n, d) unit vectors, memory mapped
+    self.norms = None     #(n,) original vector norms
+    self.documents = []
+    self.metadatas = []
+
+  def __len__(self):
+    return 0 if self.vectors is None else self.vectors.shape[0]
+
+  def exists(self):
+    """
+    True if index files are on disk
+    """
+    return (self.index_dir/'info.json').is_file()
+
+  def clear(self):
+    """
+    Delete the index files, e.g. after the collection has changed
+    """
+    self.vectors = None
+    self.norms = None
+    self.documents = []
+    self.metadatas = []
+    if self.index_dir.exists():
+      shutil.rmtree(self.index_dir)
+
+  def build(self,collection,page_size:int=5000):
+    """
+    Copy all embeddings out of a chroma collection into the index files, page by page
+
+    Parameters
+    ----------
+    collection :
+        chromadb collection
+    page_size : `int`
+        number of rows pulled from chroma at a time
+    """
+    self.clear()
+    self.index_dir.mkdir(exist_ok=True,parents=True)
+    count = collection.count()
+
+    vectors = None
+    norms = np.zeros(count,dtype=np.float32)
+    documents, metadatas = [], []
+    for offset in range(0,count,page_size):
+      page = collection.get(include=['embeddings','documents','metadatas'],limit=page_size,offset=offset)
+      emb = np.asarray(page['embeddings'],dtype=np.float32)
+      if vectors is None:
+        vectors = np.lib.format.open_memmap(self.index_dir/'vectors.npy',mode='w+',
+                                            dtype=self.dtype,shape=(count,emb.shape[1]))
+      n = np.linalg.norm(emb,axis=1)
+      norms[offset:offset+len(emb)] = n
+      vectors[offset:offset+len(emb)] = emb / np.where(n > 0,n,1)[:,None]
+      documents.extend(page['documents'])
+      metadatas.extend(page['metadatas'])
+
+    if vectors is not None:
+      vectors.flush()
+      del vectors
+    np.save(self.index_dir/'norms.npy',norms)
+    with open(self.index_dir/'records.json','w') as f:
+      json.dump({'documents':documents,'metadatas':metadatas},f)
+    with open(self.index_dir/'info.json','w') as f:
+      json.dump({'count':count,'dtype':self.dtype.name},f)
+    self.load()
+
+  def load(self):
+    """
+    Memory-map the index files
+
+    Returns
+    -------
+    `bool`
+        True if an index was loaded
+    """
+    if not self.exists():
+      return False
+    with open(self.index_dir/'info.json') as f:
+      info = json.load(f)
+    if info['count'] == 0:
+      self.vectors = np.zeros((0,0),dtype=self.dtype)
+      self.norms = np.zeros(0,dtype=np.float32)
+    else:
+      self.vectors = np.load(self.index_dir/'vectors.npy',mmap_mode='r')
+      self.norms = np.load(self.index_dir/'norms.npy')
+    with open(self.index_dir/'records.json') as f:
+      records = json.load(f)
+    self.documents = records['documents']
+    self.metadatas = records['metadatas']
+    return True
+
+  def search(self,vectors:np.ndarray,k:int):
+    """
+    Exact top-k search for one or more query embeddings
+
+    Parameters
+    ----------
+    vectors : `np.ndarray`
+        query embeddings, shape (d,) or (n, d)
+    k : `int`
+        number of documents per query
+
+    Returns
+    -------
+    `list`
+        per query, a list of (Document, relevance score) sorted by score
+    """
+    q = np.atleast_2d(np.asarray(vectors,dtype=np.float32))
+    k = min(k,len(self))
+    if k == 0:
+      return [[] for _ in q]
+
+    #squared l2 distance from the unit vectors and stored norms: |q|^2 + |d|^2 - 2|d| q.d_hat
+    dots = np.asarray(q.astype(self.dtype) @ self.vectors.T,dtype=np.float32)
+    dist = (q*q).sum(axis=1,keepdims=True) + self.norms[None,:]**2 - 2*self.norms[None,:]*dots
+
+    results = []
+    for row in dist:
+      top = np.argpartition(row,k-1)[:k]
+      top = top[np.argsort(row[top])]
+      results.append([(Document(page_content=self.documents[i],metadata=self.metadatas[i]),
+                       1.0 - float(row[i])/math.sqrt(2)) for i in top])
+    return results
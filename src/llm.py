@@ -0,0 +1,183 @@
+import os
+import time
+import httpx
+import ollama
+import threading
+
+class LLMClient:
+  """
+  Shared Ollama client used by the Pipeline, QuestionAnswering and the Verifier. Keeps a pooled
+  HTTP connection per endpoint, applies a timeout to every call, retries transient failures
+  with exponential backoff, and spreads calls over several Ollama servers.
+
+  Parameters
+  ----------
+  hosts : `list`
+      Ollama endpoints, e.g. ['http://gpu1:11434','http://gpu2:11434']. Defaults to OLLAMA_HOST
+      (or Ollama's default) when None
+  timeout : `float`
+      seconds allowed per call
+  retries : `int`
+      extra attempts after a connection error, timeout or 5xx/429 response
+  backoff : `float`
+      seconds to wait before the first retry, doubled every retry
+  strategy : `str`
+      'round_robin' or 'least_outstanding' (endpoint with the fewest calls in flight)
+  max_connections : `int`
+      size of the connection pool per endpoint
+  cooldown : `float`
+      seconds an endpoint is skipped after a connection error, timeout or 5xx/429 response,
+      unless every endpoint is cooling down
+
+  Usage
+  -----
+  llm = LLMClient(hosts=['http://gpu1:11434','http://gpu2:11434'],strategy='least_outstanding')
+  pipe = Pipeline(..., llm=llm)
+  """
+  def __init__(self,hosts:list=None,timeout:float=300.0,retries:int=2,backoff:float=0.5,
+               strategy:str='round_robin',max_connections:int=32,cooldown:float=10.0):
+    if strategy not in ['round_robin','least_outstanding']:
+      raise ValueError(f"strategy must be 'round_robin' or 'least_outstanding', got {strategy}")
+    self.hosts = list(hosts) if hosts else [os.getenv('OLLAMA_HOST')]
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.strategy = strategy
+    self.cooldown = cooldown
+
+    limits = httpx.Limits(max_connections=max_connections,max_keepalive_connections=max_connections)
+    self.clients = [ollama.Client(host=h,timeout=timeout,limits=limits) for h in self.hosts]
+    self.outstanding = [0]*len(self.clients)
+    self.calls = [0]*len(self.clients)
+    self.failures = [0]*len(self.clients)
+    self.down_until = [0.0]*len(self.clients)
+    self._next = 0
+    self._lock = threading.Lock()
+
+  def _acquire(self,avoid:int=None):
+    """
+    Pick an endpoint and mark a call as in flight on it
+    """
+    n = len(self.clients)
+    with self._lock:
+      others = [i for i in range(n) if i != avoid] or [avoid]
+      #skip endpoints that failed recently, unless they all have
+      now = time.monotonic()
+      candidates = [i for i in others if self.down_until[i] <= now] or others
+      if self.strategy == 'least_outstanding':
+        i = min(candidates,key=lambda c: (self.outstanding[c],self.calls[c]))
+      else:
+        #next endpoint from the cursor. retries do not move it, so they do not skew the rotation
+        i = min(candidates,key=lambda c: (c-self._next) % n)
+        if avoid is None:
+          self._next = (i+1) % n
+      self.outstanding[i] += 1
+      self.calls[i] += 1
+      return i
+
+  def _release(self,i:int,error:Exception=None):
+    """
+    Mark a call as finished, putting the endpoint in cooldown if it failed transiently
+    """
+    with self._lock:
+      self.outstanding[i] -= 1
+      if error is None:
+        self.down_until[i] = 0.0
+        return
+      self.failures[i] += 1
+      if self.retryable(error):
+        self.down_until[i] = time.monotonic() + self.cooldown
+
+  def _wait(self,i:int,attempt:int):
+    """
+    Back off before a retry, unless another endpoint is available to take it
+    """
+    with self._lock:
+      now = time.monotonic()
+      available = any(self.down_until[c] <= now for c in range(len(self.clients)) if c != i)
+    if not available:
+      time.sleep(self.backoff*2**attempt)
+
+  @staticmethod
+  def retryable(error:Exception):
+    """
+    True for errors worth retrying: connection problems, timeouts, overload and server errors
+    """
+    if isinstance(error,httpx.TransportError):
+      return True
+    if isinstance(error,ollama.ResponseError):
+      return error.status_code == 429 or error.status_code >= 500
+    return False
+
+  def generate(self,**kwargs):
+    """
+    Same arguments and return value as `ollama.generate`, including `stream=True`
+    """
+    if kwargs.get('stream',False):
+      return self._stream(**kwargs)
+
+    last = None
+    for attempt in range(self.retries+1):
+      i = self._acquire(avoid=last)
+      try:
+        response = self.clients[i].generate(**kwargs)
+        self._release(i)
+        return response
+      except Exception as e:
+        self._release(i,error=e)
+        if attempt == self.retries or not self.retryable(e):
+          raise
+        last = i
+        self._wait(i,attempt)
+
+  def _stream(self,**kwargs):
+    """
+    Streamed generate. A call is only retried if it fails before the first chunk arrives,
+    so no text is ever sent twice
+    """
+    last = None
+    for attempt in range(self.retries+1):
+      i = self._acquire(avoid=last)
+      started = False
+      error = None
+      try:
+        for part in self.clients[i].generate(**kwargs):
+          started = True
+          yield part
+        return
+      except Exception as e:
+        error = e
+        if started or attempt == self.retries or not self.retryable(e):
+          raise
+      finally:
+        #also runs if the caller stops reading the stream early
+        self._release(i,error=error)
+      last = i
+      self._wait(i,attempt)
+
+  def stats(self):
+    """
+    Per-endpoint call, failure and in-flight counts, and whether it is cooling down
+
+    Returns
+    -------
+    `list`
+        one dict per endpoint
+    """
+    with self._lock:
+      now = time.monotonic()
+      return [{'host':h,'calls':c,'failures':f,'outstanding':o,'cooling_down':d > now}
+              for h,c,f,o,d in zip(self.hosts,self.calls,self.failures,self.outstanding,self.down_until)]
+
+_DEFAULT_CLIENT = None
+_DEFAULT_LOCK = threading.Lock()
+
+def get_default_client():
+  """
+  Process-wide LLMClient used when none is injected. Built on first use from OLLAMA_HOST
+  """
+  global _DEFAULT_CLIENT
+  with _DEFAULT_LOCK:
+    if _DEFAULT_CLIENT is None:
+      _DEFAULT_CLIENT = LLMClient()
+    return _DEFAULT_CLIENT
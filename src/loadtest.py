@@ -0,0 +1,211 @@
+"""
+Load testing entry point. Replays a file of questions against a Pipeline at a fixed or ramping
+arrival rate, with a fixed number of concurrent clients, and reports throughput, latency
+percentiles per route label and error/timeout counts.
+
+Arrivals are open-loop: requests are scheduled at the target rate whether or not earlier ones
+have finished, and latency is measured from the scheduled arrival, so queueing shows up.
+
+Usage
+-----
+python -m src.loadtest --questions data/pipeline_dataset.csv --corpus /data/METCLOUD-alldata.csv \\
+    --llm-model llama3.1 --qps 2 --ramp-to 8 --duration 120 --clients 8 --output load.json
+
+Add --hosts http://gpu1:11434 http://gpu2:11434 to spread generation over several Ollama servers.
+"""
+import io
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import pandas as pd
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from src.metrics import percentiles
+
+def load_questions(path:str,field:str='question'):
+    """
+    Read questions from a .csv or .jsonl file
+
+    Parameters
+    ----------
+    path : `str`
+        the file
+    field : `str`
+        column / key holding the question text
+
+    Returns
+    -------
+    `list`
+        the questions
+    """
+    path = Path(path)
+    if path.suffix == '.csv':
+        df = pd.read_csv(path)
+    elif path.suffix in ['.jsonl','.json']:
+        df = pd.read_json(path,lines=True)
+    else:
+        raise ValueError(f'Cannot read questions from {path.suffix} files, use .csv or .jsonl')
+    if field not in df.columns:
+        raise ValueError(f'{path} has no {field} column')
+    return df[field].dropna().astype(str).tolist()
+
+def arrival_times(qps:float,duration:float,ramp_to:float=None):
+    """
+    Scheduled request times for a fixed or linearly ramping rate
+
+    Parameters
+    ----------
+    qps : `float`
+        requests per second at the start
+    duration : `float`
+        seconds to run for
+    ramp_to : `float`
+        requests per second at the end. None for a fixed rate
+
+    Returns
+    -------
+    `list`
+        seconds after the start at which each request is sent
+    """
+    end_qps = qps if ramp_to is None else ramp_to
+    times = []
+    t = 0.0
+    while t < duration:
+        times.append(t)
+        rate = qps + (end_qps-qps)*t/duration
+        t += 1/max(rate,1e-6)
+    return times
+
+def run_load(pipe,questions:list,qps:float,duration:float,clients:int=4,ramp_to:float=None,
+             timeout:float=None,**ask_kwargs):
+    """
+    Replay questions against a pipeline and measure it
+
+    Parameters
+    ----------
+    pipe : `Pipeline`
+        the pipeline under test
+    questions : `list`
+        questions, cycled through in order
+    qps : `float`
+        arrival rate, requests per second
+    duration : `float`
+        seconds to send requests for
+    clients : `int`
+        number of requests processed at once
+    ramp_to : `float`
+        ramp the arrival rate linearly from qps to this
+    timeout : `float`
+        requests slower than this many seconds are counted as timeouts. They are not
+        abandoned, and their latency still counts in the percentiles
+    ask_kwargs :
+        passed on to `pipe.ask_question`, e.g. speculative=True
+
+    Returns
+    -------
+    `dict`
+        throughput, latency percentiles overall and per route over every request that
+        finished without an error, errors and timeouts
+    """
+    schedule = arrival_times(qps,duration,ramp_to)
+    outcomes = []
+    lock = threading.Lock()
+
+    def send(question:str,scheduled:float):
+        try:
+            _,route = pipe.ask_question(question,**ask_kwargs)
+            error = None
+        except Exception as e:
+            route,error = None,type(e).__name__
+        latency = time.perf_counter()-scheduled
+        with lock:
+            outcomes.append({'route':route,'latency':latency,'error':error,
+                             'timeout':timeout is not None and error is None and latency > timeout})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for i,t in enumerate(schedule):
+            wait = start+t-time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(send,questions[i % len(questions)],start+t)
+    elapsed = time.perf_counter()-start
+
+    #slow requests stay in the latency figures, otherwise overload would hide the tail
+    ok = [o for o in outcomes if o['error'] is None]
+    in_time = [o for o in ok if not o['timeout']]
+    errors = {}
+    for o in outcomes:
+        if o['error'] is not None:
+            errors[o['error']] = errors.get(o['error'],0)+1
+
+    routes = {}
+    for route in sorted({o['route'] for o in ok}):
+        latencies = [o['latency'] for o in ok if o['route'] == route]
+        routes[route] = {'count':len(latencies),**percentiles(latencies)}
+
+    return {'sent':len(schedule),
+            'completed':len(ok),
+            'completed_in_time':len(in_time),
+            'errors':errors,
+            'timeouts':sum(o['timeout'] for o in outcomes),
+            'elapsed':elapsed,
+            'offered_qps':len(schedule)/duration if duration else None,
+            'throughput_qps':len(ok)/elapsed if elapsed else None,
+            'goodput_qps':len(in_time)/elapsed if elapsed else None,
+            'latency':percentiles([o['latency'] for o in ok]),
+            'routes':routes}
+
+def main(argv:list=None):
+    parser = argparse.ArgumentParser(description='Replay questions against a Pipeline at a target QPS')
+    parser.add_argument('--questions',required=True,help='.csv or .jsonl file of questions')
+    parser.add_argument('--field',default='question',help='column / key holding the question')
+    parser.add_argument('--corpus',required=True,help='knowledge base csv with question and response columns')
+    parser.add_argument('--llm-model',required=True,help='Ollama model name')
+    parser.add_argument('--emb-model',default='all-mpnet-base-v2',help='sentence-transformers model')
+    parser.add_argument('--hosts',nargs='+',default=None,help='Ollama endpoints, defaults to OLLAMA_HOST')
+    parser.add_argument('--balance',default='round_robin',choices=['round_robin','least_outstanding'],
+                        help='how calls are spread over --hosts')
+    parser.add_argument('--cache',default='/data/hand_off_pipeline',help='Pipeline cache folder')
+    parser.add_argument('--qps',type=float,default=1.0,help='arrival rate, or starting rate when ramping')
+    parser.add_argument('--ramp-to',type=float,default=None,help='final arrival rate for a linear ramp')
+    parser.add_argument('--duration',type=float,default=60.0,help='seconds to send requests for')
+    parser.add_argument('--clients',type=int,default=4,help='concurrent clients')
+    parser.add_argument('--timeout',type=float,default=None,help='seconds before a request counts as timed out')
+    parser.add_argument('--speculative',action='store_true',help='use speculative routing')
+    parser.add_argument('--output',default=None,help='write JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    #imported here so --help works without the heavy dependencies
+    from src.llm import LLMClient
+    from src.pipeline import Pipeline
+
+    questions = load_questions(args.questions,args.field)
+    corpus = pd.read_csv(args.corpus).rename(columns={'Question':'question','Answer':'response'})
+    llm = LLMClient(hosts=args.hosts,strategy=args.balance)
+    pipe = Pipeline(llm_model=args.llm_model,emb_model=args.emb_model,corpus=corpus,cache=args.cache,llm=llm,
+                    concurrency=args.clients)
+
+    #the pipeline prints a line per request, keep the report readable
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = run_load(pipe,questions,qps=args.qps,duration=args.duration,clients=args.clients,
+                              ramp_to=args.ramp_to,timeout=args.timeout,speculative=args.speculative)
+    finally:
+        pipe.close()
+    report['config'] = vars(args)
+    report['endpoints'] = llm.stats()
+
+    text = json.dumps(report,indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        Path(args.output).write_text(text)
+        print(f'results written to {args.output}',file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+#durations Ollama reports with each response, in nanoseconds
+OLLAMA_DURATIONS = ['total_duration','load_duration','prompt_eval_duration','eval_duration']
+
+def ollama_stats(response:dict):
+    """
+    Pull the timing and token counts out of an Ollama generate response
+
+    Parameters
+    ----------
+    response : `dict`
+        response from `ollama.generate`, or the final chunk of a stream
+
+    Returns
+    -------
+    `dict`
+        durations in seconds plus prompt_eval_count and eval_count
+    """
+    stats = {k:response.get(k,0)/1e9 for k in OLLAMA_DURATIONS if response.get(k) is not None}
+    for k in ['prompt_eval_count','eval_count']:
+        if response.get(k) is not None:
+            stats[k] = response[k]
+    return stats
+
+def throughput_stats(response:dict):
+    """
+    Token-accurate speed metrics from an Ollama generate response, split into model load,
+    prompt prefill and decode rather than one blended number
+
+    Parameters
+    ----------
+    response : `dict`
+        response from `ollama.generate`, or the final chunk of a stream
+
+    Returns
+    -------
+    `dict`
+        prompt_tokens, eval_tokens, prefill_tps, decode_tps, load_time and ttft (seconds to
+        first token, i.e. load + prefill). Missing values are None
+    """
+    stats = ollama_stats(response)
+    prompt_tokens = stats.get('prompt_eval_count')
+    eval_tokens = stats.get('eval_count')
+    prefill = stats.get('prompt_eval_duration')
+    decode = stats.get('eval_duration')
+    load = stats.get('load_duration')
+    return {'prompt_tokens':prompt_tokens,
+            'eval_tokens':eval_tokens,
+            'prefill_tps':prompt_tokens/prefill if prompt_tokens and prefill else None,
+            'decode_tps':eval_tokens/decode if eval_tokens and decode else None,
+            'load_time':load,
+            'ttft':(load or 0.0) + (prefill or 0.0) if load is not None or prefill is not None else None}
+
+def percentiles(values:list,qs:list=[50,95,99]):
+    """
+    Percentiles of a list of values
+
+    Parameters
+    ----------
+    values : `list`
+        the values
+    qs : `list`
+        percentiles to compute
+
+    Returns
+    -------
+    `dict`
+        p50, p95 ... (None if values is empty)
+    """
+    if len(values) == 0:
+        return {f'p{q}':None for q in qs}
+    return {f'p{q}':float(v) for q,v in zip(qs,np.percentile(values,qs))}
+
+class Trace:
+    """
+    Timings of one request, broken down by stage. Stages can be nested by name
+    (e.g. 'retrieval.embedding') and are summed if a stage runs more than once.
+
+    Parameters
+    ----------
+    name : `str`
+        what is being traced, e.g. 'pipeline'
+    tags :
+        extra fields stored with the trace, e.g. the route label
+    """
+    def __init__(self,name:str,**tags):
+        self.name = name
+        self.tags = dict(tags)
+        self.stages = {}
+        self.ollama = {}
+        self.started = time.time()
+        self.total = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self,stage:str,seconds:float):
+        """
+        Add time to a stage
+        """
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage,0.0) + seconds
+
+    @contextmanager
+    def stage(self,stage:str):
+        """
+        Time the body of a with block as a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(stage,time.perf_counter()-start)
+
+    def add_ollama(self,stage:str,response:dict):
+        """
+        Record the durations Ollama reports for an LLM call as sub-stages, e.g.
+        'generation.load_duration', 'generation.prompt_eval_duration', 'generation.eval_duration'
+        """
+        stats = ollama_stats(response)
+        with self._lock:
+            self.ollama[stage] = stats
+        for k in ['load_duration','prompt_eval_duration','eval_duration']:
+            if k in stats:
+                self.add(f'{stage}.{k}',stats[k])
+
+    def finish(self,**tags):
+        """
+        Stop the clock and add any final tags
+        """
+        self.total = time.perf_counter() - self._start
+        self.tags.update(tags)
+        return self
+
+    def to_dict(self):
+        """
+        `dict` version of the trace
+        """
+        return {'name':self.name,'started':self.started,'total':self.total,
+                **self.tags,'stages':dict(self.stages),'ollama':dict(self.ollama)}
+
+def stage(trace:Trace,name:str):
+    """
+    `trace.stage(name)` if there is a trace, else a do-nothing context
+    """
+    return trace.stage(name) if trace is not None else nullcontext()
+
+class MetricsSink:
+    """
+    Where finished traces go. Subclass and override `record` to send them elsewhere
+    (a log file, Prometheus, ...). This base class drops them.
+    """
+    def record(self,trace:Trace):
+        pass
+
+class InMemoryMetrics(MetricsSink):
+    """
+    Keeps per-stage latency histograms in memory and summarises them as percentiles.
+
+    Parameters
+    ----------
+    max_samples : `int`
+        samples kept per stage, and traces kept, oldest dropped first
+    """
+    def __init__(self,max_samples:int=10000):
+        self.max_samples = max_samples
+        self.histograms = {}
+        self.traces = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def record(self,trace:Trace):
+        with self._lock:
+            self.traces.append(trace)
+            for k,v in [('total',trace.total),*trace.stages.items()]:
+                if v is None:
+                    continue
+                if k not in self.histograms:
+                    self.histograms[k] = deque(maxlen=self.max_samples)
+                self.histograms[k].append(v)
+
+    def summary(self):
+        """
+        Latency summary per stage
+
+        Returns
+        -------
+        `pd.DataFrame`
+            count, mean, p50, p95 and p99 seconds per stage
+        """
+        with self._lock:
+            rows = [{'stage':k,'count':len(v),'mean':float(np.mean(v)),**percentiles(list(v))}
+                    for k,v in self.histograms.items()]
+        return pd.DataFrame(rows,columns=['stage','count','mean','p50','p95','p99'])
+
+    def clear(self):
+        """
+        Forget everything recorded so far
+        """
+        with self._lock:
+            self.histograms.clear()
+            self.traces.clear()
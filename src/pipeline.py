@@ -1,6 +1,14 @@
-import ollama
+import time
+import threading
 import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
 from src.vectordb import ChromaDB
+from src.embeddings import DEFAULT_EMBEDDING_CACHE
+from src.router import IntentRouter
+from src.semantic_cache import SemanticCache
+from src.metrics import Trace, MetricsSink, InMemoryMetrics, stage
+from src.llm import LLMClient, get_default_client
 
 def system_prompt_generic():
     """
@@ -66,7 +74,7 @@ def system_prompt_cyber():
     s += "because you are built for METCLOUD services. Importantly, do NOT embellish METCLOUDs capabilities. "
     s += "We do not want to be liable for damages! Remember, we are METCLOUD and only have knowledge on how to do METCLOUD things. "
     s += "We should only offer rough advice for helping with their cyber issues, and should direct people to more appropriate sources wherever possible"
-    return so
+    return s
 
 def system_prompt_general():
     """
@@ -83,7 +91,7 @@ def system_prompt_general():
     s += "You should apologise, and explain that we cannot answer this question. Offer to answer a different more appropriate question. "
     return s
     
-def is_metcloud_specific(question:str,model:str):
+def is_metcloud_specific(question:str,model:str,trace:Trace=None,llm:LLMClient=None):
     """
     Function to use an LLM call to determine if a question is specific to METCLOUD.
 
@@ -93,6 +101,10 @@ def is_metcloud_specific(question:str,model:str):
         the question
     model : `str`
         LLM model to use
+    trace : `Trace`
+        Optional trace to record the call's timings in
+    llm : `LLMClient`
+        client to call the model with. Defaults to the shared client
 
     Returns
     -------
@@ -121,12 +133,16 @@ def is_metcloud_specific(question:str,model:str):
     s += 'Read the question token by token. If you see "metcloud" or "METCLOUD", then return "True"'
 
     #ask model via ollama
-    response = ollama.generate(model = model,system=s,prompt = f'Does this question mention METCLOUD? : {question}',options = {'temperature':0.0})
+    llm = llm if llm is not None else get_default_client()
+    with stage(trace,'is_metcloud_specific'):
+        response = llm.generate(model = model,system=s,prompt = f'Does this question mention METCLOUD? : {question}',options = {'temperature':0.0})
+    if trace is not None:
+        trace.add_ollama('is_metcloud_specific',response)
     judgement =  response['response'].lower()
     return True if 'true' in judgement else False
 
 
-def is_cyber(question:str,model:str):
+def is_cyber(question:str,model:str,trace:Trace=None,llm:LLMClient=None):
     """
     Function to use an LLM call to determine if a question is a Cyber related question
 
@@ -136,6 +152,10 @@ def is_cyber(question:str,model:str):
         the question
     model : `str`
         LLM model to use
+    trace : `Trace`
+        Optional trace to record the call's timings in
+    llm : `LLMClient`
+        client to call the model with. Defaults to the shared client
 
     Returns
     -------
@@ -161,8 +181,12 @@ def is_cyber(question:str,model:str):
     s += 'Respond with only a single string "True" or "False". No yapping! Do not act as an assistant\n'
 
     #call LLM via ollama
-    response = ollama.generate(model = model,system=s,prompt = f'Does this question relate to cyber or cyber security? : {question}',
-                               options = {'temperature':0.0})
+    llm = llm if llm is not None else get_default_client()
+    with stage(trace,'is_cyber'):
+        response = llm.generate(model = model,system=s,prompt = f'Does this question relate to cyber or cyber security? : {question}',
+                                options = {'temperature':0.0})
+    if trace is not None:
+        trace.add_ollama('is_cyber',response)
     judgement =  response['response'].lower()
     return True if 'true' in judgement else False
     
@@ -182,6 +206,27 @@ class Pipeline:
         Knowledge base, stored in pandas dataframe. Needs `question` and `response` columns.
     cache : `str`
         Place to store embedding models and the Chroma vector database.
+    router_examples : `pd.DataFrame`
+        Optional labelled questions (`question` and `type` columns, see `data/pipeline_dataset.csv`).
+        If given, out-of-context questions are first classified with the embedding model and the
+        LLM classifiers are only called when that classification is not confident.
+    router_threshold : `float`
+        Confidence needed to trust the embedding router. See `IntentRouter`.
+    response_cache : `SemanticCache`
+        Optional semantic cache. Questions similar enough to one already answered get the
+        cached (response, route) back without retrieval or generation.
+    metrics : `MetricsSink`
+        Where per-request traces go. Defaults to an `InMemoryMetrics`, see `pipe.metrics.summary()`.
+    embedding_cache : `str`
+        On-disk embedding cache passed to `ChromaDB`, relative to cache unless absolute. None to disable
+    backend : `str`
+        Retrieval backend passed to `ChromaDB`, 'chroma' or 'flat'
+    llm : `LLMClient`
+        Client used for every LLM call, e.g. one spread over several Ollama servers.
+        Defaults to the shared client for OLLAMA_HOST
+    concurrency : `int`
+        Number of questions expected in flight at once. Sizes the speculative routing thread
+        pool, which runs up to 3 tasks per question. Call `close()` when done to release it
 
     Usage
     -----
@@ -191,9 +236,14 @@ class Pipeline:
 
     pipe.ask_question('What is METCLOUD?')
     """
-    def __init__(self,llm_model:str,emb_model:str,corpus:pd.DataFrame,cache:str = '/data/hand_off_pipeline'):
+    def __init__(self,llm_model:str,emb_model:str,corpus:pd.DataFrame,cache:str = '/data/hand_off_pipeline',
+                 router_examples:pd.DataFrame=None,router_threshold:float=None,
+                 response_cache:SemanticCache=None,metrics:MetricsSink=None,
+                 embedding_cache:str=DEFAULT_EMBEDDING_CACHE,backend:str='chroma',llm:LLMClient=None,
+                 concurrency:int=8):
         #save params to this instance
         self.llm_model = llm_model
+        self.llm       = llm if llm is not None else get_default_client()
         self.emb_model = emb_model
         self.corpus    = corpus
         self.cache     = cache
@@ -202,10 +252,157 @@ class Pipeline:
         self.chroma_db = ChromaDB(
             self.cache,
             self.corpus,
-            embedding_model = self.emb_model
+            embedding_model = self.emb_model,
+            embedding_cache = embedding_cache,
+            backend = backend
         )
 
-    def ask_question(self,question:str,threshold:float=0.5,advanced:bool=False):
+        self.response_cache = response_cache
+        self.metrics = metrics if metrics is not None else InMemoryMetrics()
+
+        #thread pool for speculative routing, created on first use
+        self.concurrency = concurrency
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        #embedding router reuses the vector database's embedding model
+        self.router = None
+        if router_examples is not None:
+            self.router = IntentRouter(
+                self.chroma_db.embedding_function,
+                router_examples,
+                threshold = router_threshold
+            )
+
+    def executor(self):
+        """
+        The speculative routing thread pool, with room for retrieval and both classifiers
+        of `concurrency` questions at once
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=3*self.concurrency)
+            return self._executor
+
+    def close(self):
+        """
+        Shut down the speculative routing thread pool, waiting for calls still running.
+        It is recreated if speculative routing is used again
+        """
+        with self._executor_lock:
+            executor,self._executor = self._executor,None
+        if executor is not None:
+            executor.shutdown(wait=True,cancel_futures=True)
+
+    def classify(self,question:str,trace:Trace=None):
+        """
+        Decide how to handle a question that has no retrieved context. The embedding router
+        is tried first if configured, and the LLM classifiers are used when it is unsure.
+
+        Parameters
+        ----------
+        question : `str`
+            question to classify
+        trace : `Trace`
+            Optional trace to record timings in
+
+        Returns
+        -------
+        `str`
+            'metcloud_specific', 'generic_cyber' or 'generic_external'
+        """
+        if self.router is not None:
+            with stage(trace,'router'):
+                label = self.router.route(question)
+            if label in ['metcloud_specific','generic_cyber','generic_external']:
+                return label
+
+        #fall back to LLM calls
+        if is_metcloud_specific(question,model = self.llm_model,trace = trace,llm = self.llm):
+            return 'metcloud_specific'
+        if is_cyber(question,model = self.llm_model,trace = trace,llm = self.llm):
+            return 'generic_cyber'
+        return 'generic_external'
+
+    def route(self,question:str,threshold:float=0.5,advanced:bool=False,speculative:bool=False,trace:Trace=None,
+              vector:list=None):
+        """
+        Decide which branch of the pipeline answers a question.
+
+        Normally this is a serial chain: retrieval, then `is_metcloud_specific`, then `is_cyber`.
+        With `speculative=True` retrieval and both classifier calls start at the same time, a
+        question containing "metcloud" skips the METCLOUD classifier (its prompt answers True
+        for those anyway), and the first decisive result wins. Calls that are no longer needed
+        are cancelled if they have not started, and their results are ignored otherwise.
+
+        Parameters
+        ----------
+        question : `str`
+            question to ask
+        threshold : `float`
+            Cosine similarity threshold. Docs need to be above this for retrieval
+        advanced : `bool`
+            Use naive rag (False) or advanced re-ranking (True)
+        speculative : `bool`
+            Run retrieval and classification concurrently
+        trace : `Trace`
+            Optional trace to record timings in
+        vector : `list`
+            Embedding of the question, if already computed (e.g. for the semantic cache)
+
+        Returns
+        -------
+        `tuple`
+            (label, context) where label is 'retrieval', 'metcloud_specific', 'generic_cyber'
+            or 'generic_external' and context is the retrieved prompt ('' if none)
+        """
+        if not speculative:
+            with stage(trace,'retrieval'):
+                context = self.chroma_db.retrieve(question,threshold=threshold,as_prompt=True,k=1,advanced=advanced,
+                                                  trace=trace,vector=vector)
+            if len(context) > 0:
+                return 'retrieval', context
+            return self.classify(question,trace=trace), context
+
+        pool = self.executor()
+
+        def retrieve():
+            with stage(trace,'retrieval'):
+                return self.chroma_db.retrieve(question,threshold=threshold,as_prompt=True,k=1,
+                                               advanced=advanced,trace=trace,vector=vector)
+
+        #start retrieval straight away
+        retrieval = pool.submit(retrieve)
+
+        #cheap checks first: the embedding router and a lexical match
+        label = None
+        if self.router is not None:
+            with stage(trace,'router'):
+                label = self.router.route(question)
+        if label not in ['metcloud_specific','generic_cyber','generic_external']:
+            label = 'metcloud_specific' if 'metcloud' in question.lower() else None
+
+        #only start the LLM classifiers if the cheap checks could not decide
+        metcloud = cyber = None
+        if label is None:
+            metcloud = pool.submit(is_metcloud_specific,question,model = self.llm_model,trace = trace,llm = self.llm)
+            cyber = pool.submit(is_cyber,question,model = self.llm_model,trace = trace,llm = self.llm)
+
+        try:
+            context = retrieval.result()
+            if len(context) > 0:
+                return 'retrieval', context
+            if label is not None:
+                return label, context
+            if metcloud.result():
+                return 'metcloud_specific', context
+            return ('generic_cyber' if cyber.result() else 'generic_external'), context
+        finally:
+            for future in [metcloud,cyber]:
+                if future is not None:
+                    future.cancel()
+
+    def ask_question(self,question:str,threshold:float=0.5,advanced:bool=False,speculative:bool=False):
         """
         Implements the pipeline logic to ask a question of the LLM. Firstly, document
         retrieval happens; if we have context, all proceeds as normal. If no docs are
@@ -221,6 +418,8 @@ class Pipeline:
             Cosine similarity threshold. Docs need to be above this for retrieval
         advanced : `bool`
             Use naive rag (False) or advanced re-ranking (True)
+        speculative : `bool`
+            Run retrieval and the classifiers concurrently. See `route`
 
         Returns
         -------
@@ -228,37 +427,151 @@ class Pipeline:
             the response
 
         """
-        #attempt to get documents
-        context = self.chroma_db.retrieve(question,threshold=threshold,as_prompt=True,k=1,advanced=advanced)
-
-        #if no documents are retrieved
-        if len(context) == 0:
-            #detect if metcloud specific
-            if is_metcloud_specific(question,model = self.llm_model):
-                print('METCLOUD Specific question asked, outside of our context!')
-                response = ollama.generate(model = self.llm_model, system = system_prompt_handoff(), 
-                                           prompt = 'Use the system message instructions to respond')
-                return response['response'], 'metcloud_specific'
-            #if not, detect if cyber question or general question
-            else:
-                if is_cyber(question,model = self.llm_model):
-                    print('Cyber question!')
-                    response = ollama.generate(model = self.llm_model,
-                                               system = system_prompt_cyber(),
-                                               prompt = question)
-                    return response['response'], 'generic_cyber'
-                else:
-                    print('Generic Question!')
-                    response = ollama.generate(model = self.llm_model,
-                                               system = system_prompt_general(),
-                                               prompt = f'use the system message instructions to explain why you cannot answer this question: {question}')
-                    return response['response'], 'generic_external'
-        #otherwise documents have been retrieved, generate as normal
-        else:
-            print('Info retrieved!')
-            user_prompt = question + '\n' + context
-            response = ollama.generate(model = self.llm_model, system = system_prompt_with_context(), 
-                                       prompt = user_prompt)
-            return response['response'], 'retrieval'
-        
+        trace = Trace('pipeline',speculative=speculative,advanced=advanced)
+
+        #check the semantic cache first. its embedding is reused for retrieval on a miss
+        vector = None
+        if self.response_cache is not None:
+            namespace = (threshold,advanced)
+            with stage(trace,'semantic_cache'):
+                vector = self.chroma_db.embedding_function.embed_query(question)
+                hit = self.response_cache.lookup(vector,namespace=namespace,version=self.chroma_db.corpus_version)
+            if hit is not None:
+                print('Cached answer!')
+                self.metrics.record(trace.finish(route=hit[1],cached=True))
+                return hit
+
+        #retrieve documents and decide which branch to take
+        label, context = self.route(question,threshold=threshold,advanced=advanced,speculative=speculative,
+                                    trace=trace,vector=vector)
+        response = self.generate(label,question,context,trace=trace)
+
+        if self.response_cache is not None:
+            self.response_cache.add(vector,response,label,namespace=namespace,version=self.chroma_db.corpus_version)
+        self.metrics.record(trace.finish(route=label,cached=False))
+        return response, label
+
+    def build_prompt(self,label:str,question:str,context:str=''):
+        """
+        Create the system and user prompts for a routed question
+
+        Parameters
+        ----------
+        label : `str`
+            route from `route`
+        question : `str`
+            question to ask
+        context : `str`
+            retrieved context, used when label is 'retrieval'
+
+        Returns
+        -------
+        `tuple`
+            (system, prompt)
+        """
+        if label == 'metcloud_specific':
+            return system_prompt_handoff(), 'Use the system message instructions to respond'
+        elif label == 'generic_cyber':
+            return system_prompt_cyber(), question
+        elif label == 'generic_external':
+            return system_prompt_general(), f'use the system message instructions to explain why you cannot answer this question: {question}'
+        #otherwise documents have been retrieved
+        return system_prompt_with_context(), question + '\n' + context
+
+    def generate(self,label:str,question:str,context:str='',trace:Trace=None):
+        """
+        Generate the response for a routed question
+
+        Parameters
+        ----------
+        label : `str`
+            route from `route`
+        question : `str`
+            question to ask
+        context : `str`
+            retrieved context, used when label is 'retrieval'
+        trace : `Trace`
+            Optional trace to record timings in
+
+        Returns
+        -------
+        `str`
+            the response
+        """
+        messages = {'metcloud_specific':'METCLOUD Specific question asked, outside of our context!',
+                    'generic_cyber':'Cyber question!',
+                    'generic_external':'Generic Question!',
+                    'retrieval':'Info retrieved!'}
+        print(messages[label])
+
+        system, prompt = self.build_prompt(label,question,context)
+        with stage(trace,'generation'):
+            response = self.llm.generate(model = self.llm_model, system = system, prompt = prompt)
+        if trace is not None:
+            trace.add_ollama('generation',response)
+        return response['response']
+
+    def stream_question(self,question:str,threshold:float=0.5,advanced:bool=False,speculative:bool=False):
+        """
+        Streaming version of `ask_question`. Yields the route label as soon as it is known,
+        then the response text piece by piece as Ollama produces it.
+
+        Parameters
+        ----------
+        question : `str`
+            question to ask
+        threshold : `float`
+            Cosine similarity threshold. Docs need to be above this for retrieval
+        advanced : `bool`
+            Use naive rag (False) or advanced re-ranking (True)
+        speculative : `bool`
+            Run retrieval and the classifiers concurrently. See `route`
+
+        Yields
+        ------
+        `str`
+            the route label first, then response chunks
+
+        Usage
+        -----
+        stream = pipe.stream_question('What is METCLOUD?')
+        label = next(stream)
+        for chunk in stream:
+            print(chunk,end='',flush=True)
+        """
+        trace = Trace('pipeline_stream',speculative=speculative,advanced=advanced)
+
+        #a cached answer is sent in one piece. its embedding is reused for retrieval on a miss
+        vector = None
+        if self.response_cache is not None:
+            namespace = (threshold,advanced)
+            with stage(trace,'semantic_cache'):
+                vector = self.chroma_db.embedding_function.embed_query(question)
+                hit = self.response_cache.lookup(vector,namespace=namespace,version=self.chroma_db.corpus_version)
+            if hit is not None:
+                response, label = hit
+                self.metrics.record(trace.finish(route=label,cached=True))
+                yield label
+                yield response
+                return
+
+        label, context = self.route(question,threshold=threshold,advanced=advanced,speculative=speculative,
+                                    trace=trace,vector=vector)
+        yield label
+
+        system, prompt = self.build_prompt(label,question,context)
+        chunks = []
+        start = time.perf_counter()
+        for part in self.llm.generate(model = self.llm_model, system = system, prompt = prompt, stream = True):
+            if len(chunks) == 0:
+                trace.add('time_to_first_token',time.perf_counter()-start)
+            chunks.append(part['response'])
+            if part.get('done'):
+                trace.add_ollama('generation',part)
+            yield part['response']
+        trace.add('generation',time.perf_counter()-start)
 
+        #only complete answers go into the cache
+        if self.response_cache is not None:
+            self.response_cache.add(vector,''.join(chunks),label,namespace=namespace,version=self.chroma_db.corpus_version)
+        self.metrics.record(trace.finish(route=label,cached=False))
@@ -1,11 +1,14 @@
 import time
 import json
 import pandas as pd
-import ollama
 
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from src.vectordb import ChromaDB
+from src.metrics import Trace, MetricsSink, InMemoryMetrics, stage, throughput_stats
+from src.llm import LLMClient, get_default_client
+from src.results_store import ResultStore
 
 class QuestionAnswering:
     """
@@ -16,9 +19,15 @@ class QuestionAnswering:
     ----------
     model : `str`
         name of the LLM supported by Ollama.
+    metrics : `MetricsSink`
+        Where per-question traces go. Defaults to an `InMemoryMetrics`, see `qa.metrics.summary()`.
+    llm : `LLMClient`
+        Client used to call the model. Defaults to the shared client for OLLAMA_HOST
     """
-    def __init__(self,model:str='llama3'):
+    def __init__(self,model:str='llama3',metrics:MetricsSink=None,llm:LLMClient=None):
         self.model = model
+        self.llm = llm if llm is not None else get_default_client()
+        self.metrics = metrics if metrics is not None else InMemoryMetrics()
 
     def process_dataset(self,df:pd.DataFrame):
         """
@@ -42,7 +51,7 @@ class QuestionAnswering:
                 queries, and if you are unsure you will ask the customer to hold while they
                 are transferred to a human agent.'''
 
-    def ask_question(self,record:dict,vector_db:ChromaDB=None,k:int=1,advanced:bool=False):
+    def ask_question(self,record:dict,vector_db:ChromaDB=None,k:int=1,advanced:bool=False,context:str=None):
         """
         Ask a question using the record
 
@@ -56,6 +65,8 @@ class QuestionAnswering:
             Number of documents to retrieve
         advanced : `bool`
             Use naive RAG (False) or advanced reranking (True)
+        context : `str`
+            Already retrieved context prompt (e.g. from `ChromaDB.retrieve_many`). Skips retrieval
 
         Returns
         -------
@@ -70,60 +81,218 @@ class QuestionAnswering:
         system = self.system_prompt()
         prompt = record['question']
 
+        trace = Trace('qa',model=self.model,id=record.get('id'))
+
         #retrieve document
-        if vector_db is not None:
+        if context is not None:
+          prompt += ' '
+          prompt += context
+        elif vector_db is not None:
           prompt += ' '
-          prompt += vector_db.retrieve(record['question'],k=k,as_prompt=True,
-                                        advanced=advanced)
+          with stage(trace,'retrieval'):
+            prompt += vector_db.retrieve(record['question'],k=k,as_prompt=True,
+                                          advanced=advanced,trace=trace)
 
         #call LLM. create a timer too
         start = time.time()
-        llm_response = ollama.generate(model = self.model, system = system, prompt = prompt,
-                                       options = {'temperature':0.0,
-                                                  'num_predict':1000})
+        with stage(trace,'generation'):
+          llm_response = self.llm.generate(model = self.model, system = system, prompt = prompt,
+                                           options = {'temperature':0.0,
+                                                      'num_predict':1000})
         end = time.time()
+        trace.add_ollama('generation',llm_response)
+        self.metrics.record(trace.finish())
         
         record['llm_response'] = llm_response['response']
         record['time'] = end - start
+        #legacy: words per second of wall time, including load and prefill
         record['tps'] = len(record['llm_response'].split()) / record['time']
+        #token counts + prefill/decode speeds, model load and time to first token from Ollama
+        record.update(throughput_stats(llm_response))
         return record
 
-    def ask_all_questions(self,save_path:str|Path,vector_db:ChromaDB=None,k:int=1,advanced:bool=False):
+    def run_config(self,vector_db:ChromaDB=None,k:int=1,advanced:bool=False):
+        """
+        Settings that determine a response. Stored with every checkpoint so that a resumed
+        run only reuses answers generated under the same configuration.
+
+        Returns
+        -------
+        `dict`
+            model, rag, k and advanced
+        """
+        rag = vector_db is not None
+        return {'model':self.model,'rag':rag,
+                'k':k if rag else None,
+                'advanced':advanced if rag else None}
+
+    def load_checkpoints(self,folder:Path,config:dict):
+        """
+        Load previously answered records from `{id}.json` files in a run folder
+
+        Parameters
+        ----------
+        folder : `Path`
+            the model folder of a run
+        config : `dict`
+            output of `run_config`. Checkpoints made under other settings are ignored
+
+        Returns
+        -------
+        `dict`
+            checkpointed records, keyed by the string of their id
+        """
+        done = {}
+        for file in Path(folder).glob('*.json'):
+            try:
+                with open(file) as f:
+                    rec = json.load(f)
+            except (json.JSONDecodeError,OSError):
+                #half-written file from a crash, ask again
+                continue
+            if all(rec.get(ki) == v for ki,v in config.items()):
+                done[str(rec['id'])] = rec
+        return done
+
+    def load_stored(self,store:ResultStore,run:str,config:dict):
+        """
+        Load previously answered records of this model from a results store
+
+        Parameters
+        ----------
+        store : `ResultStore`
+            the store
+        run : `str`
+            the run name
+        config : `dict`
+            output of `run_config`. Answers made under other settings are ignored
+
+        Returns
+        -------
+        `dict`
+            stored records, keyed by the string of their id
+        """
+        df = store.read('answers',filters=[('run','==',run),('model','==',self.model)])
+        done = {}
+        #nothing stored yet for this run
+        if len(df) == 0:
+            return done
+        for rec in df.drop(columns=['run']).to_dict(orient='records'):
+            #missing values come back as NaN
+            if all(rec.get(ki) == v or (v is None and pd.isna(rec.get(ki))) for ki,v in config.items()):
+                done[str(rec['id'])] = rec
+        return done
+
+    def ask_all_questions(self,save_path:str|Path=None,vector_db:ChromaDB=None,k:int=1,advanced:bool=False,
+                          workers:int=1,resume:bool=False,store:ResultStore=None,run:str='default',
+                          batch_size:int=64,retrieval_batch_size:int=256):
         """
         Ask all questions in the dataset
 
         Parameters
         ----------
         save_path: `str`
-            Location to save your results
+            Location to save your results as `{id}.json` checkpoints plus `all_questions.csv`.
+            Not needed when a store is given
         vector_db : `ChromaDB`
             A ChromaDB object
         k : `int`
             Number of documents to retrieve
         advanced : `bool`
             Use naive RAG (False) or advanced reranking (True)
+        workers : `int`
+            Maximum number of questions in flight at once. Values above 1 send requests
+            concurrently so Ollama can fill its parallel slots (see OLLAMA_NUM_PARALLEL).
+        resume : `bool`
+            Reuse `{id}.json` checkpoints in save_path (or answers in the store) made with the
+            same model, k and advanced settings, and only ask the remaining questions.
+        store : `ResultStore`
+            Append answers to the store's 'answers' table instead of writing files
+        run : `str`
+            Run name the answers are stored under
+        batch_size : `int`
+            Answers buffered before each append to the store
+        retrieval_batch_size : `int`
+            Questions sent to the vector database per `retrieve_many` call
 
         Returns
         -------
         `pd.DataFrame`
             The results!
         """
+        if save_path is None and store is None:
+            raise ValueError('Give a save_path or a store')
+        config = self.run_config(vector_db,k,advanced)
+
         #create folder
-        enriched_records = []
-        folder = Path(save_path) / self.model
-        folder.mkdir(exist_ok=True,parents=True)
+        if store is None:
+            folder = Path(save_path) / self.model
+            folder.mkdir(exist_ok=True,parents=True)
+            done = self.load_checkpoints(folder,config) if resume else {}
+        else:
+            done = self.load_stored(store,run,config) if resume else {}
 
-        #loop through records and enrich
-        for i,q in enumerate(tqdm(self.records)):
+        def enrich(q:dict,context:str=None):
             id = q['id']
             resp = self.ask_question(record=q,vector_db=vector_db,k=k,
-                                    advanced = advanced)
-            resp['model'] = self.model
-            with open(folder/f'{id}.json','w') as f:
+                                    advanced = advanced,context=context)
+            resp.update(config)
+            if store is not None:
+                return resp
+            #write to a temp file then rename, so a crash never leaves a partial checkpoint
+            tmp = folder/f'{id}.json.tmp'
+            with open(tmp,'w') as f:
               json.dump(resp,f)
-            enriched_records.append(resp)
+            tmp.replace(folder/f'{id}.json')
+            return resp
+
+        #loop through records and enrich. timing is taken inside ask_question so it is
+        #per request, and results are slotted back by position to keep the original order
+        enriched_records = [done.get(str(q['id'])) for q in self.records]
+        todo = [i for i,rec in enumerate(enriched_records) if rec is None]
+        if resume:
+            print(f'Resuming: {len(self.records)-len(todo)} answered, {len(todo)} to go')
+
+        #retrieve context for every remaining question up front, in batches
+        contexts = {}
+        if vector_db is not None:
+            for start in range(0,len(todo),retrieval_batch_size):
+                batch = todo[start:start+retrieval_batch_size]
+                trace = Trace('qa_batch_retrieval',model=self.model,size=len(batch))
+                with stage(trace,'retrieval'):
+                    retrieved = vector_db.retrieve_many([self.records[i]['question'] for i in batch],
+                                                        k=k,as_prompt=True,advanced=advanced,trace=trace)
+                self.metrics.record(trace.finish())
+                contexts.update(zip(batch,retrieved))
+
+        #answers waiting to be appended to the store
+        pending = []
+        def collect(i:int,resp:dict):
+            enriched_records[i] = resp
+            if store is not None:
+                pending.append(resp)
+                if len(pending) >= batch_size:
+                    store.append('answers',pending,run=run,model=self.model)
+                    pending.clear()
+
+        try:
+            if workers <= 1:
+                for i in tqdm(todo):
+                    collect(i,enrich(self.records[i],contexts.get(i)))
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = {pool.submit(enrich,self.records[i],contexts.get(i)):i for i in todo}
+                    for future in tqdm(as_completed(futures),total=len(futures)):
+                        collect(futures[future],future.result())
+        finally:
+            #keep what was answered, so a failed run can be resumed
+            if store is not None:
+                store.append('answers',pending,run=run,model=self.model)
+
         #save!
-        save_name = folder/'all_questions.csv'
         resp_df = pd.DataFrame(enriched_records)
+        if store is not None:
+            return resp_df.drop(columns=['run'],errors='ignore')
+        save_name = folder/'all_questions.csv'
         resp_df.to_csv(save_name,index=False)
         return resp_df
\ No newline at end of file
@@ -2,106 +2,260 @@ import pandas as pd
 import numpy as np
 
 from pathlib import Path
+from src.results_store import ResultStore
 
-def folder_to_dataframe(pth:Path,model_list:list):
+#per-model speed metrics from Ollama token counts, see metrics.throughput_stats
+SPEED_COLUMNS = ['prefill_tps','decode_tps','ttft','load_time']
+
+#columns of the long-format judgement frame
+LONG_COLUMNS = ['judge','model','id','consistent','sem_score','decided_by','time','tps',*SPEED_COLUMNS]
+
+#columns read from Verifier csvs. the mean_* ones are constant per file
+CSV_COLUMNS = ['id','consistent','sem_score','decided_by','mean_time','mean_tps',*[f'mean_{c}' for c in SPEED_COLUMNS]]
+
+#loaded csvs, keyed by path, with the (mtime, size) they were read at
+_CSV_CACHE = {}
+
+def clear_cache():
     """
-    Unpack a Verifier output folder into a pandas dataframe.
+    Forget every Verifier csv loaded so far
+    """
+    _CSV_CACHE.clear()
+
+def read_judge_csv(file:Path):
+    """
+    Read one Verifier output csv into the long format, reusing the cached copy if the file
+    has not changed since it was last read
+
+    Parameters
+    ----------
+    file : `Path`
+        `{judge}/{model}.csv`
+
+    Returns
+    -------
+    `pd.DataFrame`
+        see `LONG_COLUMNS`
+    """
+    stat = file.stat()
+    signature = (stat.st_mtime_ns,stat.st_size)
+    cached = _CSV_CACHE.get(file)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    df = pd.read_csv(file,usecols=lambda c: c in CSV_COLUMNS,dtype={'consistent':str})
+    df = df.rename(columns={c:c[5:] for c in df.columns if c.startswith('mean_')})
+    df['judge'] = file.parent.name
+    df['model'] = file.stem
+    df = df.reindex(columns=LONG_COLUMNS)
+    _CSV_CACHE[file] = (signature,df)
+    return df
+
+def load_judgements(pth:Path,model_list:list=None,judges:list=None):
+    """
+    Load a Verifier output folder (one sub-folder per judge, one csv per model) into a single
+    long-format frame. Unchanged files are served from a cache, so repeated calls only stat them.
 
     Parameters
     ----------
     pth : `str`
         path to folder
+    model_list : list[str]
+        models to include. None for all
+    judges : list[str]
+        judges to include. None for every sub-folder
+
+    Returns
+    -------
+    `pd.DataFrame`
+        one row per (judge, model, question), see `LONG_COLUMNS`
+    """
+    files = []
+    for dir in sorted(Path(pth).iterdir()):
+        if not dir.is_dir() or dir.name.startswith('.'):
+            continue
+        if judges is not None and dir.name not in judges:
+            continue
+        for file in sorted(dir.glob('*.csv')):
+            if model_list is None or file.stem in model_list:
+                files.append(file)
+    if len(files) == 0:
+        return pd.DataFrame(columns=LONG_COLUMNS)
+    return pd.concat([read_judge_csv(f) for f in files],ignore_index=True)
+
+def summarise_judgements(df:pd.DataFrame,ids:list=None,timing:bool=True):
+    """
+    Per-model accuracy table from a long-format judgement frame
+
+    Parameters
+    ----------
+    df : `pd.DataFrame`
+        output of `load_judgements` or the store's 'judgements' table
+    ids : `list`
+        Only score these question ids. None for all
+    timing : `bool`
+        include time, tps and the speed columns
+
+    Returns
+    -------
+    `pd.DataFrame`
+        model, [time, tps, speed columns,] `{judge}_accuracy` per judge, sem_accuracy and
+        average_accuracy (the mean of the accuracy columns, SemScore included)
+    """
+    if ids is not None:
+        #compare as strings, like ResultStore, so 1 and '1' are the same question
+        df = df.loc[df['id'].astype(str).isin(pd.Index(list(ids)).astype(str))]
+    df = df.assign(correct=df['consistent'].astype(str).str.strip().str.lower() == 'true',
+                   #NaN, not False, where no SemScore was computed
+                   sem_correct=(df['sem_score'] > 0.7).astype(float).where(df['sem_score'].notna()))
+
+    speed_columns = [c for c in SPEED_COLUMNS if df[c].notna().any()] if timing else []
+    value_columns = [*(['time','tps'] if timing else []),*speed_columns]
+    grouped = df.groupby(['model','judge']).agg(accuracy=('correct','mean'),
+                                                sem_accuracy=('sem_correct','mean'),
+                                                **{c:(c,'mean') for c in value_columns})
+
+    acc = grouped['accuracy'].unstack('judge')
+    acc.columns = [f'{judge}_accuracy' for judge in acc.columns]
+    #the same answers are scored by every judge, so these agree across judges
+    per_model = grouped[['sem_accuracy',*value_columns]].groupby(level='model').mean()
+    acc_columns = sorted([*acc.columns,'sem_accuracy'])
+
+    out = per_model.join(acc)
+    out['average_accuracy'] = out[acc_columns].mean(axis=1)
+    out = out.reset_index()
+    return out[['model',*value_columns,*acc_columns,'average_accuracy']]
+
+def store_to_dataframe(store:ResultStore,model_list:list,run:str='default',ids:list=None,judges:list=None,
+                       timing:bool=None):
+    """
+    Summarise the judgements of a run in a results store, one row per model. Only the
+    columns needed are read and the run / model partitions are filtered before reading.
+
+    Parameters
+    ----------
+    store : `ResultStore`
+        the store
     model_list : list[str]
         List of models to include
+    run : `str`
+        the run
+    ids : `list`
+        Only score these question ids. None for all
+    judges : `list`
+        Judge models to include. None for all
+    timing : `bool`
+        include time, tps and the speed columns. By default only without ids, matching
+        `folder_to_dataframe` and `filter_folder_to_dataframe`
 
     Returns
     -------
     `pd.DataFrame`
-        dataframe with results
+        see `summarise_judgements`
     """
+    filters = [('run','==',run),('model','in',list(model_list))]
+    if judges is not None:
+        filters.append(('judge','in',list(judges)))
+    df = store.read('judgements',columns=LONG_COLUMNS,filters=filters)
+    if timing is None:
+        timing = ids is None
+    return summarise_judgements(df,ids=ids,timing=timing)
 
-    #loop through folders in verifier folder, then loop through files to grab results
-    #then unpack results into a dictionary
-    records = {}
-    for dir in Path(pth).iterdir():
-        if not dir.name in ['gemma2','llama3.1']:
-            continue
-        for file in dir.iterdir():
-            if file.stem not in model_list:
-                continue
-    
-            df = pd.read_csv(file)
-            if file.stem not in records.keys():
-                records[file.stem] = {f'{dir.name}_accuracy':df['accuracy'].mean(),
-                          'model':file.stem,
-                          'time':df['mean_time'].mean(),
-                          'tps':df['mean_tps'].mean(),
-                          'sem_accuracy':df['sem_acc'].mean()}
-            
-            records[file.stem][f'{dir.name}_accuracy'] = df['accuracy'].mean()
-
-    #tidy up
-    nrecords = []
-    acc_columns = None
-    for k,v in records.items():
-        rec = {k1:v1 for k1,v1 in v.items()}
-        avg = [v1 for k1,v1 in v.items() if 'accuracy' in k1]
-        if acc_columns is None:
-            acc_columns = sorted([k1 for k1,v1 in rec.items() if 'accuracy' in k1])
-        rec['average_accuracy'] = np.mean(avg).item()
-        nrecords.append(rec)
-    acc_columns.append('average_accuracy')
-    df = pd.DataFrame(nrecords)
-    df = df[['model','time','tps',*acc_columns]]
-    return df
+def folder_to_dataframe(pth:Path,model_list:list,run:str='default',judges:list=None):
+    """
+    Unpack a Verifier output folder into a pandas dataframe.
+
+    Parameters
+    ----------
+    pth : `str` | `ResultStore`
+        path to folder, or a results store
+    model_list : list[str]
+        List of models to include
+    run : `str`
+        Run to report when reading from a results store
+    judges : list[str]
+        Judges to include. None for all of them
+
+    Returns
+    -------
+    `pd.DataFrame`
+        dataframe with results
+    """
+    if isinstance(pth,ResultStore):
+        return store_to_dataframe(pth,model_list,run=run,judges=judges)
+    return summarise_judgements(load_judgements(pth,model_list,judges))
 
 
-def filter_folder_to_dataframe(pth:Path,model_list:list,ids:list):
+def filter_folder_to_dataframe(pth:Path,model_list:list,ids:list,run:str='default',judges:list=None):
     """
-    Unpack a Verifier output folder into a pandas dataframe, but now 
+    Unpack a Verifier output folder into a pandas dataframe, but now
     filtering the questions by ID.
 
     Parameters
     ----------
-    pth : `str`
-        path to folder
+    pth : `str` | `ResultStore`
+        path to folder, or a results store
     model_list : list[str]
         List of models to include
+    ids : `list`
+        question ids to include
+    run : `str`
+        Run to report when reading from a results store
+    judges : list[str]
+        Judges to include. None for all of them
 
     Returns
     -------
     `pd.DataFrame`
         dataframe with results
     """
-    #loop through folders in verifier folder, then loop through files to grab results
-    #then unpack results into a dictionary
-    records = {}
-    for dir in Path(pth).iterdir():
-        if not dir.name in ['gemma2','llama3.1']:
-            continue
-        for file in dir.iterdir():
-            if file.stem not in model_list:
-                continue
-            df = pd.read_csv(file)
-            df = df.loc[df.id.isin(ids)]
-
-            record = {f'{dir.name}_accuracy': df['consistent'].sum()/len(df)}
-            record['sem_accuracy'] = (df['sem_score']>0.7).sum()/len(df)
-            record['model'] = file.stem
-            if file.stem in records.keys():
-                records[file.stem].update(record)
-            else:
-                records[file.stem] = record
-    #tidy up
-    nrecords = []
-    acc_columns = None
-    for k,v in records.items():
-        rec = {k1:v1 for k1,v1 in v.items()}
-        avg = [v1 for k1,v1 in v.items() if 'accuracy' in k1]
-        if acc_columns is None:
-            acc_columns = sorted([k1 for k1,v1 in rec.items() if 'accuracy' in k1])
-        rec['average_accuracy'] = np.mean(avg).item()
-        nrecords.append(rec)
-    acc_columns.append('average_accuracy')
-    df = pd.DataFrame(nrecords)
-    return df
\ No newline at end of file
+    if isinstance(pth,ResultStore):
+        return store_to_dataframe(pth,model_list,run=run,ids=ids,judges=judges)
+    return summarise_judgements(load_judgements(pth,model_list,judges),ids=ids,timing=False)
+
+def cascade_calibration(df:pd.DataFrame,bands:list=[(0.3,0.95)],by:list=None):
+    """
+    How well a SemScore-gated judge cascade (see `Verifier.judge_all_questions(cascade=...)`)
+    would agree with full judging. Simulated on the output of a full judge run, where every
+    pair has both a judge verdict and a SemScore.
+
+    Parameters
+    ----------
+    df : `pd.DataFrame`
+        judged rows with consistent and sem_score columns, e.g. a Verifier output csv or
+        `load_judgements`. Rows decided by SemScore in an earlier cascade run are ignored
+    bands : `list`
+        (low, high) bands to evaluate
+    by : `list`
+        columns to report separately, e.g. ['judge','model']
+
+    Returns
+    -------
+    `pd.DataFrame`
+        one row per band (and group): pairs, semscore_decided (share of judge calls saved),
+        agreement with the judge on those pairs overall and at each end of the band, and
+        the accuracy under full judging and under the cascade
+    """
+    if 'decided_by' in df.columns:
+        df = df.loc[df['decided_by'] != 'semscore']
+    df = df.loc[df['sem_score'].notna()]
+    judged = df['consistent'].astype(str).str.strip().str.lower() == 'true'
+
+    rows = []
+    groups = df.groupby(by) if by else [((),df)]
+    for key,group in groups:
+        key = key if isinstance(key,tuple) else (key,)
+        verdict = judged.loc[group.index]
+        score = group['sem_score']
+        for low,high in bands:
+            above,below = score >= high,score <= low
+            decided = above | below
+            cascade = verdict.where(~decided,above)
+            rows.append({**dict(zip(by or [],key)),'low':low,'high':high,'pairs':len(group),
+                         'semscore_decided':decided.mean(),
+                         'agreement':(cascade == verdict)[decided].mean() if decided.any() else np.nan,
+                         'high_agreement':verdict[above].mean() if above.any() else np.nan,
+                         'low_agreement':(~verdict[below]).mean() if below.any() else np.nan,
+                         'full_accuracy':verdict.mean(),
+                         'cascade_accuracy':cascade.mean()})
+    return pd.DataFrame(rows)
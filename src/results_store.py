@@ -0,0 +1,211 @@
+import json
+import time
+import uuid
+import operator
+import pandas as pd
+
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+#columns that identify a row. those present in a table are used to drop superseded rows
+KEY_COLUMNS = ['run','model','judge','id']
+
+OPERATORS = {'==':operator.eq,'!=':operator.ne,'<':operator.lt,'<=':operator.le,
+             '>':operator.gt,'>=':operator.ge,
+             'in':lambda s,v: s.isin(v),'not in':lambda s,v: ~s.isin(v)}
+
+class ResultStore:
+    """
+    Append-only store for answers and judgements. Each table is partitioned by run and model,
+    and every append writes one new part file, so writers never rewrite earlier results:
+
+        root/{table}/run={run}/model={model}/part-*.jsonl (or .parquet)
+
+    Rows are keyed by (run, model, id), plus the judge for judgements. If the same key is
+    written twice the most recent row wins when reading.
+
+    Parameters
+    ----------
+    root : `str`
+        folder holding the store
+    format : `str`
+        'jsonl', or 'parquet' (needs pyarrow)
+
+    Usage
+    -----
+    store = ResultStore('/data/results')
+    qa.ask_all_questions(store=store,run='rag_k3')
+    verifier.judge_all_questions(answers,'llama3.1',store=store,run='rag_k3')
+    store.read('judgements',columns=['model','consistent'],filters=[('run','==','rag_k3')])
+    """
+    def __init__(self,root:str,format:str='jsonl'):
+        if format not in ['jsonl','parquet']:
+            raise ValueError(f"format must be 'jsonl' or 'parquet', got {format}")
+        if format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("format='parquet' needs pyarrow, pip install pyarrow or use format='jsonl'")
+        self.root = Path(root)
+        self.format = format
+
+    def partition(self,table:str,run:str,model:str):
+        """
+        Folder of one (run, model) partition
+        """
+        return self.root/table/f'run={quote(str(run),safe="")}'/f'model={quote(str(model),safe="")}'
+
+    def append(self,table:str,records:list|pd.DataFrame,run:str,model:str):
+        """
+        Add a batch of rows
+
+        Parameters
+        ----------
+        table : `str`
+            e.g. 'answers' or 'judgements'
+        records : `list` | `pd.DataFrame`
+            the rows, each needing an `id`
+        run : `str`
+            name of the experiment run
+        model : `str`
+            model the rows belong to
+
+        Returns
+        -------
+        `Path`
+            the part file written, None if there were no rows
+        """
+        df = pd.DataFrame(records).copy()
+        if len(df) == 0:
+            return None
+        if 'id' not in df.columns:
+            raise ValueError('records need an id column')
+        df['run'] = run
+        df['model'] = model
+
+        folder = self.partition(table,run,model)
+        folder.mkdir(parents=True,exist_ok=True)
+        #time ordered names so later parts win, written to a temp file so readers never see half a part
+        name = f'part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.{self.format}'
+        tmp = folder/f'.{name}.tmp'
+        if self.format == 'parquet':
+            df.to_parquet(tmp,index=False)
+        else:
+            df.to_json(tmp,orient='records',lines=True,date_format='iso')
+        tmp.replace(folder/name)
+        return folder/name
+
+    def parts(self,table:str,filters:list=None):
+        """
+        Part files of a table in write order, skipping partitions ruled out by
+        '==' or 'in' filters on run and model
+        """
+        allowed = {}
+        for col,op,value in filters or []:
+            if col in ['run','model'] and op in ['==','in']:
+                values = [value] if op == '==' else value
+                allowed[col] = {quote(str(v),safe='') for v in values}
+
+        files = []
+        for run_dir in sorted((self.root/table).glob('run=*')):
+            if 'run' in allowed and run_dir.name[4:] not in allowed['run']:
+                continue
+            for model_dir in sorted(run_dir.glob('model=*')):
+                if 'model' in allowed and model_dir.name[6:] not in allowed['model']:
+                    continue
+                files.extend(model_dir.glob('part-*'))
+        return sorted(files,key=lambda f: f.name)
+
+    def _read_part(self,file:Path,columns:list=None):
+        if file.suffix == '.parquet':
+            if columns is None:
+                return pd.read_parquet(file)
+            import pyarrow.parquet as pq
+            names = pq.ParquetFile(file).schema_arrow.names
+            return pd.read_parquet(file,columns=[c for c in columns if c in names])
+        rows = []
+        with open(file) as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    rows.append(row if columns is None else {c:row[c] for c in columns if c in row})
+        return pd.DataFrame(rows)
+
+    def read(self,table:str,columns:list=None,filters:list=None,dedupe:bool=True):
+        """
+        Read a table back
+
+        Parameters
+        ----------
+        table : `str`
+            the table
+        columns : `list`
+            columns to return, None for all
+        filters : `list`
+            (column, op, value) tuples that must all hold, op one of
+            '==', '!=', '<', '<=', '>', '>=', 'in', 'not in'.
+            e.g. [('run','==','rag_k3'),('model','in',['llama3','phi3'])]
+        dedupe : `bool`
+            keep only the latest row per key
+
+        Returns
+        -------
+        `pd.DataFrame`
+            the matching rows, in write order
+        """
+        filters = filters or []
+        for _,op,_ in filters:
+            if op not in OPERATORS:
+                raise ValueError(f'unknown filter operator {op}')
+
+        #read the requested columns plus whatever filtering and dedupe need
+        needed = None
+        if columns is not None:
+            needed = list(dict.fromkeys([*columns,*[c for c,_,_ in filters],*(KEY_COLUMNS if dedupe else [])]))
+
+        frames = [self._read_part(f,needed) for f in self.parts(table,filters)]
+        frames = [f for f in frames if len(f)]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(frames,ignore_index=True)
+
+        if dedupe:
+            keys = [c for c in KEY_COLUMNS if c in df.columns]
+            #compare ids as strings so 1 and '1' are the same question
+            df = df.loc[~df[keys].astype(str).duplicated(keep='last')]
+
+        mask = pd.Series(True,index=df.index)
+        for col,op,value in filters:
+            if col not in df.columns:
+                mask &= False
+                continue
+            mask &= OPERATORS[op](df[col],value)
+        df = df.loc[mask]
+
+        if columns is not None:
+            df = df.reindex(columns=columns)
+        return df.reset_index(drop=True)
+
+    def compact(self,table:str):
+        """
+        Rewrite each partition of a table as a single part file without superseded rows.
+        Keeps reads fast after many small appends
+        """
+        for run_dir in sorted((self.root/table).glob('run=*')):
+            for model_dir in sorted(run_dir.glob('model=*')):
+                files = sorted(model_dir.glob('part-*'),key=lambda f: f.name)
+                if len(files) < 2:
+                    continue
+                df = pd.concat([self._read_part(f) for f in files],ignore_index=True)
+                keys = [c for c in KEY_COLUMNS if c in df.columns]
+                df = df.loc[~df[keys].astype(str).duplicated(keep='last')]
+                run,model = df['run'].iloc[0],df['model'].iloc[0]
+                self.append(table,df.drop(columns=['run','model']),run,model)
+                for f in files:
+                    f.unlink()
+
+    def runs(self,table:str):
+        """
+        Runs with results in a table
+        """
+        return sorted({unquote(d.name[4:]) for d in (self.root/table).glob('run=*')})
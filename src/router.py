@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+class IntentRouter:
+    """
+    Lightweight question classifier built on an already-loaded embedding function. Labelled
+    example questions are embedded once, and new questions are assigned to the nearest
+    label centroid (or by a k-nearest-neighbour vote). Used by the Pipeline to avoid LLM
+    classifier calls when the answer is obvious.
+
+    Parameters
+    ----------
+    embedding_function :
+        An embedding function with `embed_query` and `embed_documents`
+    examples : `pd.DataFrame`
+        Labelled questions, e.g. `data/pipeline_dataset.csv`
+    text_col : `str`
+        column holding the question text
+    label_col : `str`
+        column holding the label
+    method : `str`
+        'centroid' for nearest centroid or 'knn' for k-nearest-neighbour voting
+    k : `int`
+        number of neighbours for 'knn'
+    threshold : `float`
+        minimum confidence to accept a prediction. For 'centroid' this is the cosine margin
+        between the best and second best label, for 'knn' the share of neighbour votes.
+
+    Usage
+    -----
+    router = IntentRouter(chroma_db.embedding_function, pd.read_csv('data/pipeline_dataset.csv'))
+    router.route('Why is the sky blue?') #-> 'generic_external', or None if unsure
+    """
+    def __init__(self,embedding_function,examples:pd.DataFrame,text_col:str='question',label_col:str='type',
+                 method:str='centroid',k:int=5,threshold:float=None):
+        if method not in ['centroid','knn']:
+            raise ValueError(f"method must be 'centroid' or 'knn', got {method}")
+        self.embedding_function = embedding_function
+        self.method = method
+        self.k = k
+        self.threshold = threshold if threshold is not None else (0.05 if method == 'centroid' else 0.6)
+
+        #embed and normalise the examples once
+        examples = examples.dropna(subset=[text_col,label_col])
+        self.example_labels = examples[label_col].astype(str).to_numpy()
+        vectors = np.asarray(self.embedding_function.embed_documents(examples[text_col].astype(str).tolist()),
+                             dtype=np.float32)
+        self.example_vectors = vectors / np.linalg.norm(vectors,axis=1,keepdims=True)
+
+        #one normalised centroid per label
+        self.labels = sorted(set(self.example_labels))
+        centroids = np.stack([self.example_vectors[self.example_labels == l].mean(axis=0) for l in self.labels])
+        self.centroids = centroids / np.linalg.norm(centroids,axis=1,keepdims=True)
+
+    def predict(self,question:str):
+        """
+        Classify a question
+
+        Parameters
+        ----------
+        question : `str`
+            the question
+
+        Returns
+        -------
+        `tuple`
+            (label, confidence)
+        """
+        v = np.asarray(self.embedding_function.embed_query(question),dtype=np.float32)
+        v = v / np.linalg.norm(v)
+
+        if self.method == 'centroid':
+            sims = self.centroids @ v
+            order = np.argsort(sims)[::-1]
+            margin = sims[order[0]] - sims[order[1]] if len(order) > 1 else 1.0
+            return self.labels[order[0]], float(margin)
+
+        sims = self.example_vectors @ v
+        k = min(self.k,len(sims))
+        nearest = np.argpartition(-sims,k-1)[:k]
+        labels,counts = np.unique(self.example_labels[nearest],return_counts=True)
+        best = np.argmax(counts)
+        return str(labels[best]), float(counts[best]/k)
+
+    def route(self,question:str):
+        """
+        Classify a question, giving up when the prediction is not confident
+
+        Parameters
+        ----------
+        question : `str`
+            the question
+
+        Returns
+        -------
+        `str` or `None`
+            the label, or None if confidence is below the threshold
+        """
+        label,confidence = self.predict(question)
+        return label if confidence >= self.threshold else None
@@ -0,0 +1,169 @@
+import time
+import threading
+import numpy as np
+
+from collections import OrderedDict, deque
+
+class SemanticCache:
+  """
+  In-memory cache of pipeline answers looked up by question similarity. A new question whose
+  embedding has cosine similarity above the threshold with a cached question gets the cached
+  (response, route) pair back.
+
+  Parameters
+  ----------
+  threshold : `float`
+      Minimum cosine similarity for a hit
+  max_entries : `int`
+      Maximum number of cached answers. The least recently used are evicted beyond this
+  ttl : `float`
+      Seconds an answer stays valid. None to keep answers until evicted
+
+  Usage
+  -----
+  cache = SemanticCache(threshold=0.95,max_entries=5000,ttl=3600)
+  pipe = Pipeline(..., response_cache=cache)
+  cache.stats()
+  """
+  def __init__(self,threshold:float=0.95,max_entries:int=1000,ttl:float=None):
+    self.threshold = threshold
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.version = None
+
+    self._lock = threading.Lock()
+    self._entries = OrderedDict() #id -> dict, oldest use first
+    self._next_id = 0
+    self._matrix = None           #stacked vectors of _entries, rebuilt when dirty
+    self._ids = []
+
+    #best similarity of recent lookups, to help pick a threshold
+    self.recent_similarities = deque(maxlen=1000)
+    self.counters = {'hits':0,'misses':0,'evictions':0,'expirations':0,'invalidations':0}
+
+  def _check_version(self,version):
+    """
+    Drop everything if the knowledge base has changed since the answers were cached
+    """
+    if version != self.version:
+      if len(self._entries) > 0:
+        self.counters['invalidations'] += 1
+      self._entries.clear()
+      self._matrix = None
+      self.version = version
+
+  def _expire(self):
+    """
+    Remove answers older than the ttl
+    """
+    if self.ttl is None:
+      return
+    cutoff = time.time() - self.ttl
+    expired = [i for i,e in self._entries.items() if e['created'] < cutoff]
+    for i in expired:
+      del self._entries[i]
+    if expired:
+      self.counters['expirations'] += len(expired)
+      self._matrix = None
+
+  def lookup(self,vector:list,namespace=None,version=None):
+    """
+    Find a cached answer for a question embedding
+
+    Parameters
+    ----------
+    vector : `list`
+        question embedding
+    namespace :
+        anything else the answer depends on (e.g. retrieval settings). Only entries with an
+        equal namespace can hit
+    version :
+        knowledge base version. A change clears the cache
+
+    Returns
+    -------
+    `tuple` or `None`
+        (response, route) on a hit, else None
+    """
+    v = np.asarray(vector,dtype=np.float32)
+    v = v / np.linalg.norm(v)
+    with self._lock:
+      self._check_version(version)
+      self._expire()
+      if len(self._entries) == 0:
+        self.counters['misses'] += 1
+        return None
+
+      if self._matrix is None:
+        self._ids = list(self._entries.keys())
+        self._matrix = np.stack([self._entries[i]['vector'] for i in self._ids])
+
+      sims = self._matrix @ v
+      namespaces_ok = np.array([self._entries[i]['namespace'] == namespace for i in self._ids])
+      sims = np.where(namespaces_ok,sims,-1.0)
+      best = int(np.argmax(sims))
+      self.recent_similarities.append(float(sims[best]))
+
+      if sims[best] < self.threshold:
+        self.counters['misses'] += 1
+        return None
+
+      self.counters['hits'] += 1
+      entry_id = self._ids[best]
+      self._entries.move_to_end(entry_id)
+      entry = self._entries[entry_id]
+      return entry['response'], entry['route']
+
+  def add(self,vector:list,response:str,route:str,namespace=None,version=None):
+    """
+    Cache an answer
+
+    Parameters
+    ----------
+    vector : `list`
+        question embedding
+    response : `str`
+        the generated response
+    route : `str`
+        the pipeline route label
+    namespace :
+        see `lookup`
+    version :
+        see `lookup`
+    """
+    v = np.asarray(vector,dtype=np.float32)
+    v = v / np.linalg.norm(v)
+    with self._lock:
+      self._check_version(version)
+      self._entries[self._next_id] = {'vector':v,'response':response,'route':route,
+                                      'namespace':namespace,'created':time.time()}
+      self._next_id += 1
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+        self.counters['evictions'] += 1
+      self._matrix = None
+
+  def clear(self):
+    """
+    Remove every cached answer
+    """
+    with self._lock:
+      self._entries.clear()
+      self._matrix = None
+
+  def stats(self):
+    """
+    Hit-rate metrics
+
+    Returns
+    -------
+    `dict`
+        counters, hit_rate, entries and the mean best similarity of recent lookups
+    """
+    with self._lock:
+      lookups = self.counters['hits'] + self.counters['misses']
+      stats = dict(self.counters)
+      stats['hit_rate'] = self.counters['hits']/lookups if lookups else 0.0
+      stats['entries'] = len(self._entries)
+      stats['mean_recent_similarity'] = float(np.mean(self.recent_similarities)) if self.recent_similarities else None
+      return stats
@@ -1,5 +1,6 @@
 import numpy as np
-from langchain.embeddings import HuggingFaceEmbeddings
+from src.cache import cache_path
+from src.embeddings import get_embedding_function, DEFAULT_EMBEDDING_CACHE
 
 def cosine_similarity(a:list,b:list):
     """
@@ -19,7 +20,30 @@ def cosine_similarity(a:list,b:list):
     """
     return np.dot(a, b)/(np.linalg.norm(a)*np.linalg.norm(b))
 
-def sem_score(a:list,b:list,func=None,embedding_model:str="all-mpnet-base-v2",cache_dir = '/data/cache'):
+def rowwise_cosine_similarity(a:np.ndarray,b:np.ndarray):
+    """
+    Compute the cosine similarity between matching rows of two matrices
+
+    Parameters
+    ----------
+    a : `np.ndarray`
+        first matrix, shape (n, d)
+    b : `np.ndarray`
+        second matrix, shape (n, d)
+
+    Returns
+    -------
+    `np.ndarray`
+        Cosine similarity per row, shape (n,)
+    """
+    a = np.asarray(a,dtype=np.float32)
+    b = np.asarray(b,dtype=np.float32)
+    a = a / np.linalg.norm(a,axis=1,keepdims=True)
+    b = b / np.linalg.norm(b,axis=1,keepdims=True)
+    return np.einsum('ij,ij->i',a,b)
+
+def sem_score(a:list,b:list,func=None,embedding_model:str="all-mpnet-base-v2",cache_dir = '/data/cache',
+              embedding_cache:str=DEFAULT_EMBEDDING_CACHE):
     """
     Compute the SemScore, which is basically just the cosine sim between two text embeddings.
 
@@ -35,6 +59,9 @@ def sem_score(a:list,b:list,func=None,embedding_model:str="all-mpnet-base-v2",ca
         huggingface model
     cache_dir : `str`
         place to store weights
+    embedding_cache : `str`
+        on-disk embedding cache used when func is None, relative to cache_dir unless absolute.
+        None to disable
 
     Returns
     -------
@@ -42,11 +69,46 @@ def sem_score(a:list,b:list,func=None,embedding_model:str="all-mpnet-base-v2",ca
         Cosine similarity value
     """
     if func is None:
-        func = HuggingFaceEmbeddings(
-            model_name =  f'sentence-transformers/{embedding_model}',
-            cache_folder = cache_dir
-        )
+        func = get_embedding_function(embedding_model,cache_dir,cache_path(embedding_cache,cache_dir))
 
     va = func.embed_query(a)
     vb = func.embed_query(b)
-    return cosine_similarity(va,vb)
\ No newline at end of file
+    return cosine_similarity(va,vb)
+
+def sem_score_batch(list_a:list,list_b:list,func=None,embedding_model:str="all-mpnet-base-v2",
+                    cache_dir = '/data/cache',embedding_cache:str=DEFAULT_EMBEDDING_CACHE):
+    """
+    Compute the SemScore for many pairs of texts at once. Both lists are embedded with
+    batched `embed_documents` calls, and all cosines come from a single row-wise dot.
+
+    Parameters
+    ----------
+    list_a : `list`
+        first texts
+    list_b : `list`
+        second texts, aligned with list_a
+    func :
+        An embedding function
+    embedding_model : `str`
+        huggingface model
+    cache_dir : `str`
+        place to store weights
+    embedding_cache : `str`
+        on-disk embedding cache used when func is None, relative to cache_dir unless absolute.
+        None to disable
+
+    Returns
+    -------
+    `np.ndarray`
+        Cosine similarity per pair
+    """
+    if len(list_a) != len(list_b):
+        raise ValueError(f'list_a and list_b differ in length ({len(list_a)} vs {len(list_b)})')
+    if len(list_a) == 0:
+        return np.zeros(0,dtype=np.float32)
+    if func is None:
+        func = get_embedding_function(embedding_model,cache_dir,cache_path(embedding_cache,cache_dir))
+
+    va = func.embed_documents([str(t) for t in list_a])
+    vb = func.embed_documents([str(t) for t in list_b])
+    return rowwise_cosine_similarity(va,vb)
@@ -1,10 +1,17 @@
+import json
+import time
+import threading
 import pandas as pd
 import numpy as np
+from tqdm import tqdm
 from pathlib import Path
 from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.schema.document import Document
 from sentence_transformers import CrossEncoder
+from src.cache import content_hash, cache_path
+from src.embeddings import get_embedding_function, DEFAULT_EMBEDDING_CACHE
+from src.flatindex import FlatIndex
+from src.metrics import Trace, stage
 
 class ChromaDB:
   """
@@ -15,40 +22,116 @@ class ChromaDB:
   cache_dir : `str`
       place to store the vector database
   data_df : `pd.DataFrame`
-      dataframe containing data to ingest
+      dataframe containing data to ingest. Applied to an existing store too, re-embedding only
+      new or changed rows, unless the store predates incremental ingestion (see `is_legacy_store`)
   embedding_model : `str`
       Chosen embedding model
+  embedding_cache : `str`
+      On-disk embedding cache, relative to cache_dir unless absolute. Give the Verifier and
+      SemScore the same path to share it. None to disable
+  backend : `str`
+      Search backend for `retrieve`. 'chroma' goes through langchain + Chroma, 'flat' searches
+      a memory-mapped NumPy copy of the collection (see `FlatIndex`). Both return the same results
+  flat_dtype : `str`
+      Storage type of the flat index, 'float32' or 'float16'
   """
-  def __init__(self,cache_dir:str,data_df:pd.DataFrame=None, embedding_model:str = "all-mpnet-base-v2"):
+  def __init__(self,cache_dir:str,data_df:pd.DataFrame=None, embedding_model:str = "all-mpnet-base-v2",
+               embedding_cache:str = DEFAULT_EMBEDDING_CACHE,backend:str = 'chroma',flat_dtype:str = 'float32'):
+    if backend not in ['chroma','flat']:
+      raise ValueError(f"backend must be 'chroma' or 'flat', got {backend}")
+
     #store fields
     self.cache_dir = cache_dir
     self.data_df = data_df
+    self.backend = backend
+    self.load_times = {}
     
-    #create embedding function
+    #create embedding function, with the shared embedding cache in front of it.
+    #weights are only loaded when something first needs embedding
     self.embedding_model = f'sentence-transformers/{embedding_model}'
-    self.embedding_function = HuggingFaceEmbeddings(
-        model_name=self.embedding_model,
-        cache_folder=str(self.cache_dir)+'/huggingface_cache'
+    self.embedding_function = get_embedding_function(
+        embedding_model,
+        str(self.cache_dir)+'/huggingface_cache',
+        cache_path(embedding_cache,self.cache_dir)
     )
 
-    #Create a cross encoder for reranking
-    self.reranker = CrossEncoder(
-      model_name = 'cross-encoder/ms-marco-MiniLM-L-6-v2',
-      max_length = 512 #response
-    )
+    #cross encoder for reranking, loaded on first use by advanced retrieval
+    self._reranker = None
+    self._reranker_lock = threading.Lock()
+    self.rerank_stats = {'reranked':0,'skipped':0}
+    self._stats_lock = threading.Lock()
 
     self.chromadb_dir = Path(self.cache_dir)/'chromadb'
+
+    #bumped whenever the knowledge base changes, so caches built on it can be invalidated
+    self.corpus_version = 0
+
+    #numpy copy of the collection for the flat backend, built or mapped on first use
+    self._flat_index = FlatIndex(Path(self.cache_dir)/'flat_index',dtype=flat_dtype)
+    self._flat_index_lock = threading.Lock()
     
     #create a vector store
+    start = time.time()
     self.vector_store = Chroma(
         persist_directory = str(self.chromadb_dir),
         embedding_function = self.embedding_function
     )
+    self.load_times['vector_store'] = time.time() - start
 
-    #only ingest if documents dont exist
-    if len(self.vector_store.get()['documents']) == 0:
-      if self.data_df is not None:    
+    #ingest whenever a dataframe is given. unchanged rows are skipped by their content hash,
+    #so reopening an existing store only embeds new or edited rows
+    if self.data_df is not None:
+      if self.is_legacy_store():
+        print(f'{self.chromadb_dir} was built without content hashes, so data_df is not ingested. '
+              'Delete it to rebuild the store')
+      else:
+        start = time.time()
         self.ingest_df(data_df)
+        self.load_times['ingest'] = time.time() - start
+
+  @property
+  def reranker(self):
+    """
+    The CrossEncoder reranker, loaded on first access
+    """
+    with self._reranker_lock:
+      if self._reranker is None:
+        start = time.time()
+        self._reranker = CrossEncoder(
+          model_name = 'cross-encoder/ms-marco-MiniLM-L-6-v2',
+          max_length = 512 #response
+        )
+        self.load_times['reranker'] = time.time() - start
+    return self._reranker
+
+  def startup_report(self):
+    """
+    Timing breakdown of what has been loaded so far
+
+    Returns
+    -------
+    `dict`
+        seconds spent per component, None for components not loaded yet
+    """
+    report = {'vector_store':self.load_times.get('vector_store'),
+              'ingest':self.load_times.get('ingest'),
+              'embedding_model':getattr(self.embedding_function,'load_time',None),
+              'reranker':self.load_times.get('reranker')}
+    report['flat_index'] = self.load_times.get('flat_index')
+    return report
+
+  @property
+  def flat_index(self):
+    """
+    The FlatIndex, memory-mapped from disk if present or built from the collection otherwise
+    """
+    with self._flat_index_lock:
+      if self._flat_index.vectors is None:
+        start = time.time()
+        if not self._flat_index.load() or len(self._flat_index) != self.vector_store._collection.count():
+          self._flat_index.build(self.vector_store._collection)
+        self.load_times['flat_index'] = time.time() - start
+    return self._flat_index
 
   @staticmethod
   def metadata_func(record:dict):
@@ -68,41 +151,128 @@ class ChromaDB:
     keys = ['id','context','response']
     return {k:record[k] for k in keys if k in record}
   
-  def ingest_df(self,df:pd.DataFrame):
+  @staticmethod
+  def record_id(record:dict):
+    """
+    Stable id of a record. Uses the `id` column if there is one, else a hash of the question
+
+    Parameters
+    ----------
+    `dict`
+        A record
+
+    Returns
+    -------
+    `str`
+        the id
+    """
+    if record.get('id') is not None and not pd.isna(record['id']):
+      return str(record['id'])
+    return content_hash(record['question'])
+
+  def is_legacy_store(self):
     """
-    ingest a dataframe into chromadb
+    True if the collection was built before incremental ingestion. Its rows have random ids
+    and no content hash, so upserting the same data into it would store every row twice
+    """
+    existing = self.vector_store._collection.get(limit=1,include=['metadatas'])
+    return len(existing['ids']) > 0 and 'content_hash' not in (existing['metadatas'][0] or {})
+
+  def ingest_df(self,df:pd.DataFrame,batch_size:int=256):
+    """
+    ingest a dataframe into chromadb. Rows are upserted by `record_id`, and a row whose
+    question and metadata are unchanged since the last ingest is not embedded again.
 
     Parameters
     ---------
     df : `pd.DataFrame`
         pandas dataframe to ingest
+    batch_size : `int`
+        number of rows embedded and written at a time
+
+    Returns
+    -------
+    `int`
+        number of rows added or updated
     """
-    #convert to records
-    records = df.to_dict(orient='records')
-
-    #loop through records create langchain document
-    docs = []
-    for record in records:
-      raw_doc = Document(page_content=record['question'],
-                          metadata = self.metadata_func(record))
-      docs.append(raw_doc)
-
-    #create a chroma from the documents using embedding function
-    chroma = Chroma.from_documents(docs,self.embedding_function,
-                                   persist_directory=str(self.chromadb_dir))
-
-    #add documents to our vector store 
-    self.vector_store._collection.add(
-        embeddings = chroma.get()['embeddings'],
-        metadatas = chroma.get()['metadatas'],
-        documents = chroma.get()['documents'],
-        ids = chroma.get()['ids']
-    )
+    collection = self.vector_store._collection
+    changed = 0
+
+    for start in range(0,len(df),batch_size):
+      #convert this batch to records, keyed by id so repeated ids keep the last row
+      batch = {}
+      for record in df.iloc[start:start+batch_size].to_dict(orient='records'):
+        metadata = self.metadata_func(record)
+        metadata['content_hash'] = content_hash(record['question'],json.dumps(metadata,sort_keys=True,default=str))
+        batch[self.record_id(record)] = (str(record['question']),metadata)
+
+      #skip rows already stored with the same content
+      existing = collection.get(ids=list(batch.keys()),include=['metadatas'])
+      stored = {i:(m or {}).get('content_hash') for i,m in zip(existing['ids'],existing['metadatas'])}
+      ids = [i for i,(q,m) in batch.items() if stored.get(i) != m['content_hash']]
+      if len(ids) == 0:
+        continue
 
-    #save!
-    self.vector_store.persist()
+      #embed + write straight into our vector store
+      documents = [batch[i][0] for i in ids]
+      collection.upsert(
+          embeddings = self.embedding_function.embed_documents(documents),
+          metadatas = [batch[i][1] for i in ids],
+          documents = documents,
+          ids = ids
+      )
+      changed += len(ids)
+
+    #save! the flat index is now stale, it is rebuilt on next use
+    if changed > 0:
+      self.vector_store.persist()
+      self.corpus_version += 1
+      with self._flat_index_lock:
+        self._flat_index.clear()
+    return changed
+
+  def ingest_file(self,path:str,chunksize:int=10000,batch_size:int=256):
+    """
+    Stream a CSV or JSONL knowledge base from disk into chromadb, one chunk at a time, so
+    corpora larger than memory can be ingested. Needs a `question` column, and uses the
+    `response`, `context` and `id` columns when present (see `metadata_func`).
+
+    Parameters
+    ---------
+    path : `str`
+        .csv, .jsonl or .json (one record per line) file to ingest
+    chunksize : `int`
+        number of rows read from disk at a time
+    batch_size : `int`
+        number of rows embedded and written at a time
+
+    Returns
+    -------
+    `int`
+        number of rows added or updated
+    """
+    path = Path(path)
+    if path.suffix == '.csv':
+      chunks = pd.read_csv(path,chunksize=chunksize)
+    elif path.suffix in ['.jsonl','.json']:
+      chunks = pd.read_json(path,lines=True,chunksize=chunksize)
+    else:
+      raise ValueError(f'Cannot ingest {path.suffix} files, use .csv or .jsonl')
+
+    changed = 0
+    rows = 0
+    with tqdm(desc=f'ingesting {path.name}',unit='rows') as progress:
+      for chunk in chunks:
+        if 'question' not in chunk.columns:
+          raise ValueError(f'{path} has no question column')
+        changed += self.ingest_df(chunk,batch_size=batch_size)
+        rows += len(chunk)
+        progress.update(len(chunk))
+        progress.set_postfix(changed=changed)
+    print(f'{rows} rows read, {changed} added or updated')
+    return changed
   
-  def rerank(self,query:str,retrieval:list):
+  def rerank(self,query:str,retrieval:list,top:int=3,margin:float=None,window:int=None):
     """
     Rerank the documents using CrossEncoder model
 
@@ -112,34 +282,170 @@ class ChromaDB:
         the original question
     retrieval : `list`
         List of retrieved documents
+    top : `int`
+        number of documents to keep
+    margin : `float`
+        skip reranking when the best vector score beats the second best by more than this
+    window : `int`
+        only rerank this many of the best vector hits
 
     Returns
     -------
     `list`
         top three reranked documents
     """
-    scores = self.reranker.predict(
-      [(query,ret[0].page_content) for ret in retrieval]
-    )
-    return [retrieval[i] for i in np.argsort(scores)[::-1]][:3]
+    return self.rerank_many([query],[retrieval],top=top,margin=margin,window=window)[0]
+
+  def rerank_many(self,queries:list,retrievals:list,top:int=3,margin:float=None,window:int=None):
+    """
+    Rerank the documents of many queries with a single batched CrossEncoder call.
+
+    By default every retrieved document is reranked. Setting `margin` makes this adaptive:
+    when the top vector hit is clearly dominant the CrossEncoder is skipped and the vector
+    order is kept. `window` limits reranking to the best few vector hits. How often
+    reranking was skipped is counted in `rerank_stats`.
+
+    Parameters
+    ----------
+    queries : `list`
+        the original questions
+    retrievals : `list`
+        List of retrieved documents per question, best vector score first
+    top : `int`
+        number of documents to keep per question
+    margin : `float`
+        skip reranking when the best vector score beats the second best by more than this
+    window : `int`
+        only rerank this many of the best vector hits
+
+    Returns
+    -------
+    `list`
+        top reranked documents per question
+    """
+    #decide which queries need the cross encoder
+    candidates = []
+    skipped = 0
+    for retrieval in retrievals:
+      retrieval = retrieval[:window] if window is not None else retrieval
+      dominant = (margin is not None and len(retrieval) > 1
+                  and retrieval[0][1] - retrieval[1][1] > margin)
+      if dominant:
+        skipped += 1
+      candidates.append((retrieval,not dominant))
+
+    with self._stats_lock:
+      self.rerank_stats['skipped'] += skipped
+      self.rerank_stats['reranked'] += len(retrievals) - skipped
+
+    pairs = [(query,ret[0].page_content) for query,(retrieval,needed) in zip(queries,candidates)
+             if needed for ret in retrieval]
+    scores = self.reranker.predict(pairs) if len(pairs) > 0 else []
+
+    #split the flat scores back up per query
+    reranked = []
+    start = 0
+    for retrieval,needed in candidates:
+      if not needed:
+        reranked.append(retrieval[:top])
+        continue
+      s = scores[start:start+len(retrieval)]
+      start += len(retrieval)
+      reranked.append([retrieval[i] for i in np.argsort(s)[::-1]][:top])
+    return reranked
+
+  def rerank_skip_rate(self):
+    """
+    Share of reranking calls that skipped the CrossEncoder
+
+    Returns
+    -------
+    `float`
+    """
+    total = self.rerank_stats['skipped'] + self.rerank_stats['reranked']
+    return self.rerank_stats['skipped']/total if total else 0.0
   
-  def retrieve(self,query:str, k:int=4, key:str='response',as_prompt:bool=False, advanced:bool=False, 
-               threshold:float=None):
+  def search(self,query:str,k:int=4):
     """
-    Retrieve similar documents!
+    Top-k vector search using the configured backend
 
     Parameters
     ----------
-    query : str
+    query : `str`
         The question
-    k : int
+    k : `int`
         How many documents to retrieve
+
+    Returns
+    -------
+    `list`
+        (Document, relevance score) pairs, best first
+    """
+    return self.search_vectors([self.embedding_function.embed_query(query)],k)[0]
+
+  def search_many(self,queries:list,k:int=4):
+    """
+    Top-k vector search for many queries. All queries are embedded in one batch
+
+    Parameters
+    ----------
+    queries : `list`
+        The questions
+    k : `int`
+        How many documents to retrieve per question
+
+    Returns
+    -------
+    `list`
+        per question, (Document, relevance score) pairs, best first
+    """
+    if len(queries) == 0:
+      return []
+    return self.search_vectors(self.embedding_function.embed_documents(list(queries)),k)
+
+  def search_vectors(self,vectors:list,k:int=4):
+    """
+    Top-k vector search for already embedded queries, using the configured backend
+
+    Parameters
+    ----------
+    vectors : `list`
+        query embeddings
+    k : `int`
+        How many documents to retrieve per query
+
+    Returns
+    -------
+    `list`
+        per query, (Document, relevance score) pairs, best first
+    """
+    if self.backend == 'flat':
+      return self.flat_index.search(vectors,k)
+
+    #same query + relevance scoring as similarity_search_with_relevance_scores
+    results = self.vector_store._collection.query(
+        query_embeddings = [list(v) for v in vectors],
+        n_results = k,
+        include = ['documents','metadatas','distances']
+    )
+    relevance = self.vector_store._select_relevance_score_fn()
+    return [[(Document(page_content=doc,metadata=meta or {}),relevance(dist))
+             for doc,meta,dist in zip(docs,metas,dists)]
+            for docs,metas,dists in zip(results['documents'],results['metadatas'],results['distances'])]
+
+  @staticmethod
+  def format_results(retrieval:list,key:str='response',as_prompt:bool=False,threshold:float=None):
+    """
+    Turn retrieved (Document, score) pairs into the output of `retrieve`
+
+    Parameters
+    ----------
+    retrieval : `list`
+        (Document, score) pairs
     key : `str`
         Which field in metadata to extract info from
     as_prompt : `bool`
         Convert document back into prompt format
-    advanced : `bool`
-        Use advanced reranking rather than naive
     threshold : `float`
         Minimum cosine sim for docs to be retrieved + used
 
@@ -148,20 +454,6 @@ class ChromaDB:
     `str` or `list`
         the document prompt or list
     """
-
-    #if advanced, set k = 10
-    if advanced:
-      k = 10
-
-    #perform retrieval
-    retrieval = self.vector_store.similarity_search_with_relevance_scores(
-        query,k
-    )
-
-    #rerank docs if asked
-    if advanced:
-      retrieval = self.rerank(query,retrieval)
-
     #filter out bad docs
     if threshold is not None:
         retrieval = [(r,i) for r,i in retrieval if i > threshold]
@@ -183,4 +475,110 @@ class ChromaDB:
     prompt = 'Use the following information to generate your answer:\n'
     for r in results:
       prompt += f'- {r}\n'
-    return prompt
\ No newline at end of file
+    return prompt
+
+  def retrieve(self,query:str, k:int=4, key:str='response',as_prompt:bool=False, advanced:bool=False, 
+               threshold:float=None, rerank_top:int=3, rerank_margin:float=None, rerank_window:int=None,
+               trace:Trace=None, vector:list=None):
+    """
+    Retrieve similar documents!
+
+    Parameters
+    ----------
+    query : str
+        The question
+    k : int
+        How many documents to retrieve
+    key : `str`
+        Which field in metadata to extract info from
+    as_prompt : `bool`
+        Convert document back into prompt format
+    advanced : `bool`
+        Use advanced reranking rather than naive
+    threshold : `float`
+        Minimum cosine sim for docs to be retrieved + used
+    rerank_top : `int`
+        Documents kept after reranking
+    rerank_margin : `float`
+        Adaptive reranking: skip the CrossEncoder when the top vector score leads by more than this
+    rerank_window : `int`
+        Adaptive reranking: only rerank this many of the best vector hits
+    trace : `Trace`
+        Optional trace to record embedding, vector_search and rerank timings in
+    vector : `list`
+        Embedding of the query, if already computed. Skips embedding it again
+
+    Returns
+    -------
+    `str` or `list`
+        the document prompt or list
+    """
+
+    #if advanced, set k = 10
+    if advanced:
+      k = 10
+
+    #perform retrieval
+    if vector is None:
+      with stage(trace,'embedding'):
+        vector = self.embedding_function.embed_query(query)
+    with stage(trace,'vector_search'):
+      retrieval = self.search_vectors([vector],k)[0]
+
+    #rerank docs if asked
+    if advanced:
+      with stage(trace,'rerank'):
+        retrieval = self.rerank(query,retrieval,top=rerank_top,margin=rerank_margin,window=rerank_window)
+
+    return self.format_results(retrieval,key=key,as_prompt=as_prompt,threshold=threshold)
+
+  def retrieve_many(self,queries:list, k:int=4, key:str='response',as_prompt:bool=False, advanced:bool=False, 
+                    threshold:float=None, rerank_top:int=3, rerank_margin:float=None, rerank_window:int=None,
+                    trace:Trace=None):
+    """
+    Batched `retrieve`. All queries are embedded together, searched together and, if
+    advanced, every (query, document) pair goes through the CrossEncoder in one call.
+
+    Parameters
+    ----------
+    queries : `list`
+        The questions
+    k : int
+        How many documents to retrieve per question
+    key : `str`
+        Which field in metadata to extract info from
+    as_prompt : `bool`
+        Convert document back into prompt format
+    advanced : `bool`
+        Use advanced reranking rather than naive
+    threshold : `float`
+        Minimum cosine sim for docs to be retrieved + used, applied per question
+    rerank_top : `int`
+        Documents kept after reranking
+    rerank_margin : `float`
+        Adaptive reranking: skip the CrossEncoder when the top vector score leads by more than this
+    rerank_window : `int`
+        Adaptive reranking: only rerank this many of the best vector hits
+    trace : `Trace`
+        Optional trace to record embedding, vector_search and rerank timings in
+
+    Returns
+    -------
+    `list`
+        what `retrieve` returns, one per question
+    """
+    #if advanced, set k = 10
+    if advanced:
+      k = 10
+
+    if len(queries) == 0:
+      return []
+    with stage(trace,'embedding'):
+      vectors = self.embedding_function.embed_documents(list(queries))
+    with stage(trace,'vector_search'):
+      retrievals = self.search_vectors(vectors,k)
+    if advanced:
+      with stage(trace,'rerank'):
+        retrievals = self.rerank_many(queries,retrievals,top=rerank_top,margin=rerank_margin,window=rerank_window)
+
+    return [self.format_results(r,key=key,as_prompt=as_prompt,threshold=threshold) for r in retrievals]
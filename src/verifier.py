@@ -1,12 +1,137 @@
 import json
 import re
-import ollama
+import ast
 import pandas as pd
 
 from tqdm import tqdm
 from pathlib import Path
-from langchain.embeddings import HuggingFaceEmbeddings
-from src.semscore import sem_score
+from concurrent.futures import ThreadPoolExecutor
+from src.semscore import sem_score, sem_score_batch
+from src.embeddings import get_embedding_function, DEFAULT_EMBEDDING_CACHE
+from src.llm import LLMClient, get_default_client
+from src.results_store import ResultStore
+from src.cache import SQLiteLRUCache, content_hash, cache_path
+
+#recorded as the verdict when the judge output could not be parsed, so failures stay visible
+UNPARSED = 'Unparsed'
+
+#token budget per judge call in structured mode: full verdict, verdict only
+NUM_PREDICT = {'full':256,'verdict':16}
+
+#bump whenever system_prompt or the parsing changes, so cached verdicts are not reused
+PROMPT_VERSION = 2
+
+#file name of the verdict cache, kept under the Verifier's cache_dir unless an absolute path is given
+DEFAULT_VERDICT_CACHE = 'verdict_cache.sqlite'
+
+#SemScore band sent to the judge in cascade mode. pairs outside it are decided by SemScore
+DEFAULT_CASCADE = (0.3,0.95)
+
+def normalise_verdict(value):
+  """
+  Map a judge's verdict (True, "true", "False" ...) to the strings 'True' / 'False'
+
+  Returns
+  -------
+  `str`
+      'True', 'False', or None if it is neither
+  """
+  if isinstance(value,bool):
+    return str(value)
+  if isinstance(value,str) and value.strip().strip('"\'').lower() in ['true','false']:
+    return value.strip().strip('"\'').capitalize()
+  return None
+
+def parse_verdict(text:str,required_fields:list):
+  """
+  Safely parse a judge output into a dictionary. Tries the text as JSON, then the first
+  {...} block in it as JSON or a Python literal. Nothing is executed. If the output was cut
+  off by the token cap, the "consistent" value is still read from the incomplete JSON and
+  the justification is kept as far as it got.
+
+  Parameters
+  ----------
+  text : `str`
+      LLM generated response
+  required_fields : `list`
+      fields to keep. 'consistent' must be present and a True/False verdict
+
+  Returns
+  -------
+  `dict`
+      the fields with 'consistent' as 'True' or 'False', or None if the text cannot be parsed
+  """
+  candidates = [text]
+  match = re.search(r'\{.*\}',text,flags=re.DOTALL)
+  if match is not None:
+    candidates.append(match.group(0))
+    #the prompt's example wraps values in brackets, which some judges copy
+    candidates.append(match.group(0).replace('(','').replace(')',''))
+
+  for candidate in candidates:
+    for loads in [json.loads,ast.literal_eval]:
+      try:
+        data = loads(candidate)
+      except (ValueError,SyntaxError,TypeError,MemoryError,RecursionError):
+        continue
+      if not isinstance(data,dict):
+        continue
+      verdict = normalise_verdict(data.get('consistent'))
+      if verdict is None:
+        continue
+      data = {k:v for k,v in data.items() if k in required_fields}
+      data['consistent'] = verdict
+      return data
+
+  #truncated output, e.g. {"consistent": "True", "justification": "The samples ...
+  match = re.search(r'["\']consistent["\']\s*:\s*["\']?(true|false)\b',text,flags=re.IGNORECASE)
+  if match is None:
+    return None
+  data = {'consistent':match.group(1).capitalize()}
+  if 'justification' in required_fields:
+    partial = re.search(r'["\']justification["\']\s*:\s*["\'](.*)',text,flags=re.DOTALL)
+    data['justification'] = partial.group(1).rstrip('"\'}\n ') if partial is not None else ''
+  return data
+
+class VerdictCache:
+  """
+  On-disk memo of judge verdicts. Judge calls are deterministic (fixed temperature and seed),
+  so a verdict is reused whenever the same judge, prompt version and settings see the same
+  (generated response, ground truth) pair again.
+
+  Parameters
+  ----------
+  path : `str`
+      location of the sqlite file
+  max_entries : `int`
+      maximum number of verdicts kept, least recently used evicted first
+  """
+  def __init__(self,path:str,max_entries:int=1_000_000):
+    self.cache = SQLiteLRUCache(path,max_entries=max_entries)
+
+  @staticmethod
+  def key(model:str,mode:str,gen_response:str,ground_truth_answer:str,temperature:float,seed:int):
+    """
+    Cache key of one judge call
+    """
+    return content_hash(model,PROMPT_VERSION,mode,content_hash(gen_response),
+                        content_hash(ground_truth_answer),temperature,seed)
+
+  def get(self,key:str):
+    """
+    The cached verdict `dict`, or None
+    """
+    value = self.cache.get(key)
+    return json.loads(value) if value is not None else None
+
+  def put(self,key:str,verdict:dict):
+    self.cache.put(key,json.dumps(verdict).encode('utf-8'))
+
+  def stats(self):
+    """
+    hits, misses, hit_rate and entries, see `SQLiteLRUCache.stats`
+    """
+    return self.cache.stats()
 
 class Verifier:
   """
@@ -20,17 +145,42 @@ class Verifier:
       name of sentence-transformer model. For SemScore
   cache_dir : `str`
       Place to store weights
+  embedding_cache : `str`
+      On-disk embedding cache, so ground truths are not re-embedded every run. Relative to
+      cache_dir unless absolute. None to disable
+  llm : `LLMClient`
+      Client used to call the judge. Defaults to the shared client for OLLAMA_HOST
+  structured : `bool`
+      Ask Ollama for JSON output (format='json') and cap the judge's tokens
+  verdict_only : `bool`
+      Only ask for the "consistent" verdict, no justification. Far fewer decode tokens
+  num_predict : `int`
+      Token cap per judge call. Defaults to `NUM_PREDICT` in structured mode, no cap otherwise
+  verdict_cache : `str`
+      On-disk verdict cache, so pairs already judged are not sent to the judge again. Relative to
+      cache_dir unless absolute. None to disable
   """
-  def __init__(self,model:str='phi3',embedding_model:str = "all-mpnet-base-v2",cache_dir:str = '/data/cache'):
+  def __init__(self,model:str='phi3',embedding_model:str = "all-mpnet-base-v2",cache_dir:str = '/data/cache',
+               embedding_cache:str = DEFAULT_EMBEDDING_CACHE,llm:LLMClient = None,
+               structured:bool = False,verdict_only:bool = False,num_predict:int = None,
+               verdict_cache:str = DEFAULT_VERDICT_CACHE):
     #llm model
     self.model=model
+    self.llm = llm if llm is not None else get_default_client()
+
+    #judge output settings
+    self.structured = structured
+    self.verdict_only = verdict_only
+    if num_predict is None and structured:
+      num_predict = NUM_PREDICT['verdict' if verdict_only else 'full']
+    self.num_predict = num_predict
+    self.fields = ['consistent'] if verdict_only else ['consistent','justification']
+
+    #verdicts of pairs judged before
+    self.verdict_cache = VerdictCache(cache_path(verdict_cache,cache_dir)) if verdict_cache is not None else None
 
-    #embedding function for Semantic Score
-    embedding_model = f'sentence-transformers/{embedding_model}'
-    self.emb_func = HuggingFaceEmbeddings(
-        model_name = embedding_model,
-        cache_folder = cache_dir
-    )
+    #embedding function for Semantic Score, shared across the process
+    self.emb_func = get_embedding_function(embedding_model,cache_dir,cache_path(embedding_cache,cache_dir))
 
   def system_prompt(self,gen_response:str,ground_truth_answer:str):
     """
@@ -49,7 +199,8 @@ class Verifier:
     """
     format = {'consistent':'(either "True" or "False")',
                'justification':'(description why the samples are consistent)'}
-      
+    format = {k:v for k,v in format.items() if k in self.fields}
+
     p  = '# YOUR ROLE\n'
     p += 'You are a question and answering validation capability. '
     p += 'You can accurately compare two potential pieces of text for similarity and consistency.'
@@ -65,7 +216,10 @@ class Verifier:
     p += 'Return your judgement as a JSON compatible dictionary. An example of '
     p += 'this format is:\n\n'
     p += json.dumps(format)
-    p += '\n\nYour output should only contain the "consistent" and "justification". '
+    if self.verdict_only:
+      p += '\n\nYour output should only contain "consistent". '
+    else:
+      p += '\n\nYour output should only contain the "consistent" and "justification". '
     p += 'Do not act as an assistant '
     p += 'and do not yap. Make sure your output is valid JSON.'
     return p
@@ -79,26 +233,19 @@ class Verifier:
     ----------
     text : `str`
         LLM generated response
-    required_fields : `dict`
+    required_fields : `list`
         fields for dictionary to contain
 
     Returns
     -------
     `dict`
-        The response
+        The response. If it cannot be parsed, 'consistent' is `UNPARSED` and the
+        justification holds the raw text
     """
-    text = text.replace("(","")
-    text = text.replace(")","")
-
-    #use regex to find pattern matching dict
-    matches = re.findall(r'\{(.*?)\}', text)
-    for match in matches:
-      #reconstruct dictionary + impose fields
-      data = eval('{' + match + '}')
-      data = {k:v for k,v in data.items() if k in required_fields}
-      return data
-    #return stock otherwise
-    return {'consistent':False,'justification':'missed'}
+    data = parse_verdict(text,required_fields)
+    if data is None:
+      return {'consistent':UNPARSED,'justification':text}
+    return data
 
   def judge_llm(self,gen_response:str,ground_truth_answer:str,
                        temperature:float=0.0,seed:int=1000):
@@ -115,19 +262,37 @@ class Verifier:
         the llm temperature
     seed : `int`
         the seed
+
+    Returns
+    -------
+    `dict`
+        'consistent' ('True', 'False' or `UNPARSED`) and, unless verdict_only, 'justification'
     """
+    #reuse the verdict if this judge has seen the pair before
+    if self.verdict_cache is not None:
+      mode = f'structured={self.structured},verdict_only={self.verdict_only},num_predict={self.num_predict}'
+      key = self.verdict_cache.key(self.model,mode,gen_response,ground_truth_answer,temperature,seed)
+      cached = self.verdict_cache.get(key)
+      if cached is not None:
+        return cached
+
     #get system prompt
     system = self.system_prompt(gen_response,ground_truth_answer)
     prompt = 'Compare the information'
 
-    #call ollama
-    response = ollama.generate(model=self.model,system=system,prompt=prompt,
-                               options={'temperature':temperature,'seed':seed})
+    #call ollama. in structured mode the output is forced to JSON and capped
+    options = {'temperature':temperature,'seed':seed}
+    if self.num_predict is not None:
+      options['num_predict'] = self.num_predict
+    response = self.llm.generate(model=self.model,system=system,prompt=prompt,
+                                 format='json' if self.structured else '',options=options)
 
     #sanitise output
-    fields = ['consistent','justification']
-    response = self.extract_and_parse(response['response'],fields)
+    response = self.extract_and_parse(response['response'],self.fields)
 
+    #failures are not cached, so a fixed parser can retry them
+    if self.verdict_cache is not None and response['consistent'] != UNPARSED:
+      self.verdict_cache.put(key,response)
     return response
 
   def judge_sem_score(self,gen_response:str,ground_truth_answer:str):
@@ -151,7 +316,53 @@ class Verifier:
           ground_truth_answer,
           self.emb_func)
 
-  def judge_all_questions(self,df:pd.DataFrame,model:str,save_dir:str):
+  def judge_sem_scores(self,gen_responses:list,ground_truth_answers:list):
+      """
+      Get semantic scores for many pairs in one batched embedding pass
+
+      Parameters
+      ----------
+      gen_responses : `list`
+        LLM generated responses
+      ground_truth_answers : `list`
+        Ground truth answers, aligned with gen_responses
+
+      Returns
+      -------
+      `np.ndarray`
+          semscore per pair
+      """
+      return sem_score_batch(
+          gen_responses,
+          ground_truth_answers,
+          self.emb_func)
+
+  def semscore_verdict(self,score:float,low:float,high:float):
+    """
+    Verdict for a pair the cascade does not send to the judge
+
+    Parameters
+    ----------
+    score : `float`
+        the pair's SemScore, at or below low or at or above high
+    low : `float`
+        scores at or below this are inconsistent
+    high : `float`
+        scores at or above this are consistent
+
+    Returns
+    -------
+    `dict`
+        same fields as `judge_llm`
+    """
+    if score >= high:
+      verdict = {'consistent':'True','justification':f'SemScore {score:.3f} >= {high}'}
+    else:
+      verdict = {'consistent':'False','justification':f'SemScore {score:.3f} <= {low}'}
+    return {k:v for k,v in verdict.items() if k in self.fields}
+
+  def judge_all_questions(self,df:pd.DataFrame,model:str,save_dir:str=None,workers:int=1,
+                          store:ResultStore=None,run:str='default',cascade:tuple=None):
     """
     Judge all question responses
 
@@ -162,49 +373,110 @@ class Verifier:
     model : `str`
         Name of the model being assessed
     save_dir : `str`
-        Where to save the results
+        Where to save the results as `{model}.csv`. None to skip
+    workers : `int`
+        Maximum number of judge calls in flight at once. With more than one worker
+        the judge calls run concurrently while SemScore is computed for the whole
+        dataframe in one batched embedding pass.
+    store : `ResultStore`
+        Also append one row per question to the store's 'judgements' table, with the
+        judge, verdict, SemScore and the answer's speed metrics
+    run : `str`
+        Run name the judgements are stored under
+    cascade : `tuple`
+        (low, high) SemScore band, e.g. `DEFAULT_CASCADE`. SemScore is computed first and only
+        pairs strictly inside the band go to the judge; the rest are consistent at or above high
+        and inconsistent at or below low. The `decided_by` column says which path decided each
+        row. Check a band with `reporting.cascade_calibration` before relying on it
+
+    Returns
+    -------
+    `pd.DataFrame`
+        one row per question
     """
 
     #split into records
     records = df.to_dict(orient='records')
-
-    #loop through records
-    marked = []
-    for rec in tqdm(records):
-      gt = str(rec['response'])
-      pr = str(rec['llm_response'])
-      id = rec['id']
-
-      #add llm judge response
-      resp = self.judge_llm(pr,gt)
-      
-      nrec = {'id':id}
-      nrec.update(resp)
-
-      #add sem score
-      if self.emb_func is not None:
-          nrec['sem_score'] = self.judge_sem_score(gt,pr)
-
-      marked.append(nrec)
+    gts = [str(rec['response']) for rec in records]
+    prs = [str(rec['llm_response']) for rec in records]
+
+    #cascade: score every pair first, then only judge the uncertain ones
+    scores = None
+    decided = {}
+    if cascade is not None:
+      if self.emb_func is None:
+        raise ValueError('cascade needs SemScore, give the Verifier an embedding model')
+      low,high = cascade
+      scores = self.judge_sem_scores(prs,gts)
+      decided = {i:self.semscore_verdict(score,low,high) for i,score in enumerate(scores)
+                 if score <= low or score >= high}
+      print(f'cascade: {len(decided)} of {len(records)} pairs decided by SemScore')
+
+    if workers <= 1:
+      #loop through records
+      marked = []
+      for i,(rec,gt,pr) in enumerate(tqdm(zip(records,gts,prs),total=len(records))):
+        #add llm judge response, unless the cascade has decided already
+        resp = decided[i] if i in decided else self.judge_llm(pr,gt)
+
+        nrec = {'id':rec['id']}
+        nrec.update(resp)
+        nrec['decided_by'] = 'semscore' if i in decided else 'judge'
+
+        #add sem score
+        if scores is not None:
+            nrec['sem_score'] = scores[i]
+        elif self.emb_func is not None:
+            nrec['sem_score'] = self.judge_sem_score(gt,pr)
+
+        marked.append(nrec)
+    else:
+      #start the judge calls, then embed everything while they run
+      with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {i:pool.submit(self.judge_llm,pr,gt) for i,(gt,pr) in enumerate(zip(gts,prs))
+                   if i not in decided}
+        if scores is None and self.emb_func is not None:
+          scores = self.judge_sem_scores(prs,gts)
+
+        marked = []
+        for i,rec in enumerate(tqdm(records)):
+          nrec = {'id':rec['id']}
+          nrec.update(decided[i] if i in decided else futures[i].result())
+          nrec['decided_by'] = 'semscore' if i in decided else 'judge'
+          if scores is not None:
+            nrec['sem_score'] = scores[i]
+          marked.append(nrec)
 
     #combine results
     marked_df = pd.DataFrame(marked)
-    marked_df['mean_time'] =df['time'].mean()
-    marked_df['mean_tps'] =df['tps'].mean()
 
-    save_dir = Path(save_dir)
-    save_dir.mkdir(exist_ok=True,parents=True)
+    if store is not None:
+      rows = marked_df.copy()
+      rows['judge'] = self.model
+      for col in ['time','tps','prefill_tps','decode_tps','ttft','load_time']:
+        if col in df.columns:
+          rows[col] = df[col].values
+      store.append('judgements',rows,run=run,model=model)
 
-    #group up the results
-    marked_df['accuracy'] = marked_df['consistent'].value_counts()['True'] / len(marked_df)
+    marked_df['mean_time'] =df['time'].mean()
+    marked_df['mean_tps'] =df['tps'].mean()
+    for col in ['prefill_tps','decode_tps','ttft','load_time']:
+      if col in df.columns:
+        marked_df[f'mean_{col}'] = df[col].mean()
+
+    #group up the results. unparsed verdicts count as inconsistent, but say how many there were
+    unparsed = (marked_df['consistent'] == UNPARSED).sum()
+    if unparsed:
+      print(f'{unparsed} of {len(marked_df)} judgements for {model} could not be parsed')
+    if self.verdict_cache is not None:
+      stats = self.verdict_cache.stats()
+      print(f"verdict cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+    marked_df['accuracy'] = (marked_df['consistent'].astype(str) == 'True').sum() / len(marked_df)
     if self.emb_func is not None:
         marked_df['sem_acc'] = sum(marked_df['sem_score']>0.7)/len(marked_df)
-    marked_df.to_csv(save_dir/f'{model}.csv',index=False)
-
-    
 
-    
-    
-
-  
-  
\ No newline at end of file
+    if save_dir is not None:
+      save_dir = Path(save_dir)
+      save_dir.mkdir(exist_ok=True,parents=True)
+      marked_df.to_csv(save_dir/f'{model}.csv',index=False)
+    return marked_df